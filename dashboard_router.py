@@ -13,6 +13,7 @@ from __future__ import annotations
 
 import io
 import json
+import logging
 import os
 import secrets
 import time
@@ -22,6 +23,9 @@ from typing import Any, Dict, List
 from fastapi import APIRouter, Form, Query, Request
 from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 
+# Child of the service's "amo2gsheet" logger → app.log + stdout via its queue.
+_log = logging.getLogger("amo2gsheet.dashboard")
+
 # ── Staff sheet cache (avoid re-fetching on every dashboard refresh) ─────────
 _staff_cache: Dict = {"data": None, "ts": 0.0}
 _STAFF_CACHE_TTL = 300  # seconds
@@ -161,7 +165,6 @@ def create_dashboard_router(service) -> APIRouter:
         group:     str = Query(default="", description="Group filter: A / B / C / D"),
         force:     int = Query(default=0,  description="Set to 1 to bypass cache"),
     ) -> Dict[str, Any]:
-        import traceback
         _empty = {"groups": {}, "date_from": date_from, "date_to": date_to,
                   "total_consul": 0, "total_zakas": 0, "total_otkaz": 0, "total_dumka": 0,
                   "total_summa": 0, "avg_conversion": 0.0}
@@ -193,7 +196,7 @@ def create_dashboard_router(service) -> APIRouter:
                     _staff_cache["data"] = staff_by_code
                     _staff_cache["ts"]   = now_ts
                 except Exception as exc:
-                    print(f"[DASHBOARD] Could not load Staff sheet: {exc}")
+                    _log.warning("[DASHBOARD] Could not load Staff sheet: %s", exc)
                     if _staff_cache["data"] is not None:
                         staff_by_code = _staff_cache["data"]  # use stale data on error
 
@@ -215,7 +218,7 @@ def create_dashboard_router(service) -> APIRouter:
             try:
                 leads = service.amo.fetch_leads_by_date_range(date_from, date_to)
             except Exception as exc:
-                print(f"[DASHBOARD] Leads fetch failed (Приемщик): {exc}")
+                _log.warning("[DASHBOARD] Leads fetch failed (Приемщик): %s", exc)
 
             # Cache raw leads for the export endpoint (same TTL as stats)
             _leads_cache[cache_key] = {"ts": time.monotonic(), "leads": leads}
@@ -367,7 +370,7 @@ def create_dashboard_router(service) -> APIRouter:
             return result
 
         except Exception as exc:
-            print(f"[DASHBOARD] Error in stats endpoint: {traceback.format_exc()}")
+            _log.exception("[DASHBOARD] Error in stats endpoint")
             return {**_empty, "error": str(exc), "date_from": date_from, "date_to": date_to}
 
     # ── Monthly report endpoint ───────────────────────────────────────────────
@@ -385,7 +388,6 @@ def create_dashboard_router(service) -> APIRouter:
         Returns the same structure as /api/dashboard/stats plus a daily breakdown
         suitable for building monthly salary reports.
         """
-        import traceback
         try:
             if not month:
                 from datetime import date as _date
@@ -412,7 +414,7 @@ def create_dashboard_router(service) -> APIRouter:
                     _staff_cache["data"] = staff_by_code
                     _staff_cache["ts"]   = now_ts
                 except Exception as exc:
-                    print(f"[DASHBOARD] Could not load Staff sheet: {exc}")
+                    _log.warning("[DASHBOARD] Could not load Staff sheet: %s", exc)
                     if _staff_cache["data"] is not None:
                         staff_by_code = _staff_cache["data"]
 
@@ -492,7 +494,7 @@ def create_dashboard_router(service) -> APIRouter:
             }
 
         except Exception as exc:
-            print(f"[DASHBOARD] monthly-report error: {traceback.format_exc()}")
+            _log.exception("[DASHBOARD] monthly-report error")
             return {"error": str(exc), "month": month}
 
     # ── XLSX Export endpoint ──────────────────────────────────────────────────
@@ -503,7 +505,6 @@ def create_dashboard_router(service) -> APIRouter:
         date_to:   str = Query(default=""),
         group:     str = Query(default=""),
     ):
-        import traceback
         if not _user(request):
             from fastapi import HTTPException
             raise HTTPException(status_code=401, detail="Unauthorized")
@@ -725,7 +726,7 @@ def create_dashboard_router(service) -> APIRouter:
                 headers={"Content-Disposition": f'attachment; filename="{filename}"'},
             )
         except Exception as exc:
-            print(f"[DASHBOARD] Export error: {traceback.format_exc()}")
+            _log.exception("[DASHBOARD] Export error")
             return {"error": str(exc)}
 
     return router
@@ -85,6 +85,10 @@ TOKEN_STORE_PATH   = Path(os.getenv("AMO_TOKEN_STORE", ".amo_tokens.json"))
 BASE_URL           = f"https://{AMO_SUBDOMAIN}.amocrm.ru"
 
 
+# One keep-alive session for every AmoCRM call, so the import pays the TLS
+# handshake once instead of once per request.
+_session = requests.Session()
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Token helpers (mirrors sync_service.py)
 # ─────────────────────────────────────────────────────────────────────────────
@@ -115,7 +119,7 @@ def _save_tokens(access_token: str, refresh_token: str) -> None:
 def _is_valid(access_token: str) -> bool:
     if not access_token:
         return False
-    r = requests.get(
+    r = _session.get(
         f"{BASE_URL}/api/v4/account",
         headers={"Authorization": f"Bearer {access_token}"},
         timeout=20,
@@ -126,7 +130,7 @@ def _is_valid(access_token: str) -> bool:
 def _refresh(refresh_token: str) -> str:
     if not refresh_token:
         raise RuntimeError("No refresh_token. Run sync_service.py first to complete OAuth.")
-    r = requests.post(
+    r = _session.post(
         f"{BASE_URL}/oauth2/access_token",
         json={
             "client_id": AMO_CLIENT_ID,
@@ -152,7 +156,7 @@ def _exchange_code(code_or_url: str) -> str:
         parsed = urlparse(value)
         code = parse_qs(parsed.query).get("code", [""])[0] if parsed.query else value
 
-    r = requests.post(
+    r = _session.post(
         f"{BASE_URL}/oauth2/access_token",
         json={
             "client_id": AMO_CLIENT_ID,
@@ -189,14 +193,14 @@ def _headers() -> Dict[str, str]:
 
 
 def api_get(endpoint: str, params: Optional[Dict] = None) -> Dict[str, Any]:
-    r = requests.get(f"{BASE_URL}{endpoint}", headers=_headers(), params=params, timeout=30)
+    r = _session.get(f"{BASE_URL}{endpoint}", headers=_headers(), params=params, timeout=30)
     if r.status_code >= 400:
         raise RuntimeError(f"GET {endpoint} → {r.status_code}: {r.text[:400]}")
     return r.json()
 
 
 def api_post(endpoint: str, body: Any) -> Dict[str, Any]:
-    r = requests.post(f"{BASE_URL}{endpoint}", headers=_headers(), json=body, timeout=60)
+    r = _session.post(f"{BASE_URL}{endpoint}", headers=_headers(), json=body, timeout=60)
     if r.status_code >= 400:
         raise RuntimeError(f"POST {endpoint} → {r.status_code}: {r.text[:600]}")
     return r.json() if r.text else {}
@@ -32,6 +32,7 @@ backfill_log
 
 from __future__ import annotations
 
+import functools
 import sqlite3
 import threading
 from collections import defaultdict
@@ -45,6 +46,14 @@ from typing import Any, Dict, List, Optional
 
 _DEFAULT_DUMKA_RECOVERY_DAYS = 5  # leads in ДУМКА can be recovered within this window
 
+_EPOCH_DATE = date(1970, 1, 1)
+
+
+@functools.lru_cache(maxsize=1024)
+def _day_str(day_number: int) -> str:
+    """YYYY-MM-DD for a day counted from 1970-01-01 (events in a range share few days)."""
+    return (_EPOCH_DATE + timedelta(days=day_number)).isoformat()
+
 
 class KPIStore:
     """Thread-safe SQLite-backed KPI event store."""
@@ -58,6 +67,8 @@ class KPIStore:
         self.db_path = Path(db_path)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
         self.tz_offset = tz_offset
+        self._tzinfo = timezone(timedelta(hours=tz_offset))
+        self._tz_offset_sec = int(tz_offset * 3600)
         self.dumka_recovery_days = dumka_recovery_days
         self._lock = threading.Lock()
         self._init_db()
@@ -112,7 +123,7 @@ class KPIStore:
                 """)
 
     def _tz(self) -> timezone:
-        return timezone(timedelta(hours=self.tz_offset))
+        return self._tzinfo
 
     def _now_str(self) -> str:
         return datetime.now(self._tz()).isoformat(timespec="seconds")
@@ -122,7 +133,7 @@ class KPIStore:
 
     def _ts_to_date(self, ts: int) -> str:
         """Convert Unix timestamp to YYYY-MM-DD in configured timezone."""
-        return datetime.fromtimestamp(ts, self._tz()).strftime("%Y-%m-%d")
+        return _day_str((ts + self._tz_offset_sec) // 86400)
 
     # ─────────────────────────────────────────────────────────────────────────
     # Write: consul
@@ -432,9 +443,6 @@ class KPIStore:
         """
         import time as _time
 
-        def _ts_to_date(ts: int) -> str:
-            return datetime.fromtimestamp(ts, self._tz()).strftime("%Y-%m-%d")
-
         try:
             ts_from = int(datetime.strptime(date_from, "%Y-%m-%d").timestamp())
             ts_to   = int(datetime.strptime(date_to,   "%Y-%m-%d").timestamp()) + 86399
@@ -481,7 +489,7 @@ class KPIStore:
             after   = (ev.get("value_after") or [{}])[0]
             new_sid = int((after.get("lead_status") or {}).get("id", 0) or 0)
             ev_ts   = int(ev.get("created_at", 0) or 0)
-            ev_date = _ts_to_date(ev_ts)
+            ev_date = self._ts_to_date(ev_ts)
 
             if new_sid in consul_status_ids:
                 lead_events[lead_id].append(("consul", ev_date, ev_ts))
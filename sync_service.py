@@ -1,20 +1,30 @@
+import asyncio
+import atexit
+import functools
+import gzip
 import json
 import logging
 import os
 import queue
+import random
 import re
 import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
-from typing import Any, Dict, List, Optional
-from urllib.parse import parse_qs, urlparse
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Tuple
+from urllib.parse import parse_qs, parse_qsl, urlparse
 import gspread
 import requests
+from requests.adapters import HTTPAdapter
 from env_loader import load_env
 from fastapi import FastAPI, Request
-from gspread.utils import ValidationConditionType
+from fastapi.concurrency import run_in_threadpool
+from gspread.utils import ValidationConditionType, absolute_range_name
 from dashboard_router import create_dashboard_router
 from kpi_store import KPIStore
 
@@ -29,6 +39,10 @@ load_env()
 #
 # Set LOG_DIR in .env to override the default ./logs directory.
 # The same messages also print to stdout so systemd journald keeps working.
+#
+# Loggers only enqueue records (QueueHandler); a single QueueListener thread does
+# the formatting, file rotation and stdout writes, so request and worker threads
+# never block on log I/O.
 
 def _setup_logging() -> None:
     log_dir = Path(os.getenv("LOG_DIR", "logs"))
@@ -52,23 +66,29 @@ def _setup_logging() -> None:
     # Root "amo2gsheet" logger → app.log + stdout
     root = logging.getLogger("amo2gsheet")
     root.setLevel(logging.DEBUG)
-    if not root.handlers:  # avoid double-adding on reload
-        root.addHandler(_file_handler("app.log"))
-        _console = logging.StreamHandler()
-        _console.setFormatter(fmt)
-        root.addHandler(_console)
-
-    # Child loggers mirror to root (app.log) AND write to their own file
+    if root.handlers:  # avoid double-adding on reload
+        return
+    _console = logging.StreamHandler()
+    _console.setFormatter(fmt)
+    sinks: List[logging.Handler] = [_file_handler("app.log"), _console]
+
+    # Child loggers propagate to root (app.log + stdout); each also gets its own
+    # file, which only accepts records from that child.
     for name, fname in (
         ("amo2gsheet.leads",    "leads.log"),
         ("amo2gsheet.webhooks", "webhooks.log"),
         ("amo2gsheet.amo_api",  "amo_api.log"),
     ):
-        child = logging.getLogger(name)
-        child.setLevel(logging.DEBUG)
-        if not child.handlers:
-            child.addHandler(_file_handler(fname))
-        child.propagate = True  # also write to app.log
+        logging.getLogger(name).setLevel(logging.DEBUG)
+        h = _file_handler(fname)
+        h.addFilter(logging.Filter(name))
+        sinks.append(h)
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    root.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, *sinks, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # drain anything still queued on shutdown
 
 
 _setup_logging()
@@ -103,6 +123,7 @@ COLUMNS = [
     "Воронка",
     "Статус",
 ]
+_COLUMN_INDEX: Dict[str, int] = {name: i for i, name in enumerate(COLUMNS)}
 
 # Maps raw AmoCRM pipeline name → display name written to Google Sheets.
 # Populated dynamically from AMO at startup; every pipeline found in the AMO
@@ -118,33 +139,50 @@ try:
 except Exception:
     pass
 
-# Maps raw AmoCRM status name → proper Russian display name written to Google Sheets
-STATUS_DISPLAY_MAP: Dict[str, str] = {
+# Maps raw AmoCRM status name → proper Russian display name written to Google Sheets.
+# One spelling per status is enough: look names up through _status_display_name(),
+# which also matches case, surrounding-whitespace and Latin-lookalike variants.
+# This and the two sheet/AMO status maps below are read-only views: they are read
+# concurrently by the webhook worker and the poller and must never change at runtime.
+# (PIPELINE_DISPLAY_MAP above stays a dict — pipelines are auto-registered into it.)
+STATUS_DISPLAY_MAP: Mapping[str, str] = MappingProxyType({
     "Неразобранное":              "Неразобранное",
     "КОНСУЛТАЦИЯ":                "Консультация",
     "Консультация":               "Консультация",
     "ДУМКА":                      "Раздумье",
     "Раздумье":                   "Раздумье",
     "Заказ":                      "Заказ",
-    "ЗАКАЗ":                      "Заказ",
     "NOMERATSIYALANMAGAN ZAKAZ":  "В процессе",
     "Заказ без нумерации":        "В процессе",
-    "ЗАКАЗ БЕЗ НУМЕРАЦИИ":       "В процессе",
     "ЗАЗАЗ БЕЗ НУМЕРАЦИИ":       "В процессе",
-    "ЗАКАЗ ОТПРАВЛЕН":            "У курера",
     "Заказ отправлен":            "У курера",
     "OTKAZ":                      "Отказ",
-    "ОТКАЗ":                      "Отказ",
     "Отказ":                      "Отказ",
     "Успешно":                    "Успешно",
-    "Успешно ":                   "Успешно",
     "Успешно реализовано":        "Успешно",
     "Закрыто и не реализовано":   "Закрыто и не реализовано",
-}
-
-ID_COL_INDEX = COLUMNS.index("ID")
-STATUS_COL_INDEX = COLUMNS.index("Статус")
-ORDER_NUM_COL_INDEX = COLUMNS.index("Заказ №")
+})
+
+ID_COL_INDEX = _COLUMN_INDEX["ID"]
+STATUS_COL_INDEX = _COLUMN_INDEX["Статус"]
+ORDER_NUM_COL_INDEX = _COLUMN_INDEX["Заказ №"]
+PIPELINE_COL_INDEX = _COLUMN_INDEX["Воронка"]
+_BUDGET_COL_INDEX = _COLUMN_INDEX["Бюджет сделки"]
+_CONTACT_NAME_COL_INDEX = _COLUMN_INDEX["Ф.И.О."]
+_CONTACT_PHONE_COL_INDEX = _COLUMN_INDEX["Контактный номер"]
+_COMPANY_COL_INDEX = _COLUMN_INDEX["Компания"]
+_RESPONSIBLE_COL_INDEX = _COLUMN_INDEX["Ответственный"]
+_ORDER_DATE_COL_INDEX = _COLUMN_INDEX["Дата заказа"]
+# A1 column letters, computed once for every range built from them (narrow reads,
+# status-cell writes, dropdown validation).
+# ID and Заказ № are adjacent (B:C), as are Воронка and Статус (T:U), so each
+# pair comes back in a single range.
+ID_COL_LETTER = chr(ord("A") + ID_COL_INDEX)
+ORDER_NUM_COL_LETTER = chr(ord("A") + ORDER_NUM_COL_INDEX)
+PIPELINE_COL_LETTER = chr(ord("A") + PIPELINE_COL_INDEX)
+STATUS_COL_LETTER = chr(ord("A") + STATUS_COL_INDEX)
+# Start row of an append result range, e.g. "Sheet1!A51:T51" or "'03.2026'!A51:T51" → 51
+_UPDATED_RANGE_START_ROW_RE = re.compile(r"[A-Za-z](\d+):")
 
 # ── Normalization for AMO status names ─────────────────────────────────────────
 # Some pipelines (e.g. Rushana) have status names with mixed Latin/Cyrillic
@@ -173,6 +211,21 @@ _STATUS_DISPLAY_LOWERED: Dict[str, str] = {
     k.lower(): v for k, v in STATUS_DISPLAY_MAP.items()
 }
 
+
+@functools.lru_cache(maxsize=256)
+def _status_display_name(name: str) -> str:
+    """Display name for an AMO status name, or "" when it is not mapped.
+
+    Tries the exact key, then the Latin-lookalike and plain lower-case tables.
+    """
+    name = name.strip()
+    return (
+        STATUS_DISPLAY_MAP.get(name)
+        or _STATUS_DISPLAY_NORMALIZED.get(_normalize_amo_name(name))
+        or _STATUS_DISPLAY_LOWERED.get(name.lower())
+        or ""
+    )
+
 # AMO display name to target when admin fills in Заказ № on the sheet.
 # "Заказ отправлен" maps to display name "У курера" in STATUS_DISPLAY_MAP.
 ORDER_NUM_FILLED_AMO_STATUS_DISPLAY = "У курера"
@@ -183,23 +236,23 @@ ORDER_NUM_FILLED_AMO_STATUS_DISPLAY = "У курера"
 #   "Успешно"   (sheet) → NOT pushed to AMO at all — it is display-only for staff.
 #   "Отказ"     (sheet) → AMO reject step.
 #   "В процессе"(sheet) → AMO В процессе (rarely patched manually).
-SHEET_STATUS_TO_AMO_DISPLAY: Dict[str, str] = {
+SHEET_STATUS_TO_AMO_DISPLAY: Mapping[str, str] = MappingProxyType({
     "В процессе": "В процессе",
     # When admin sets "У курера" in the sheet the lead is considered delivered —
     # move it to AMO "Успешно реализовано" (the won/closed status).  The lookup key
-    # "Успешно" resolves to that status via pipeline_status_display_to_id.
+    # "Успешно" resolves to that status via SyncService.resolve_status_id.
     "У курера":   "Успешно",
     # "Успешно" is intentionally absent — it must never be pushed to AMO.
     # It is a display-only label that staff use to mark their own record keeping.
     "Отказ":      "Отказ",
-}
+})
 
 # Maps an AMO display status name → the status that should be written to the Google Sheet
 # when a tracked lead receives that AMO status via webhook.
 # e.g. when a manager manually sets "Раздумье" in AMO, the sheet row is updated to "Отказ".
-AMO_STATUS_TO_SHEET_OVERRIDE: Dict[str, str] = {
+AMO_STATUS_TO_SHEET_OVERRIDE: Mapping[str, str] = MappingProxyType({
     "Раздумье": "Отказ",
-}
+})
 
 # ── KPI status groupings (used by KPI store event recording) ─────────────────
 # Consul: the lead enters the consultation step — this is the "Лид" credit.
@@ -229,6 +282,15 @@ def _extract_staff_code(lead: Dict[str, Any]) -> str:
     return ""
 
 
+# LEADS_CREATED_AFTER date formats keyed by shape: (date separator, number of ':').
+_CREATED_AFTER_FORMATS: Dict[Tuple[str, int], str] = {
+    (".", 2): "%d.%m.%Y %H:%M:%S",
+    (".", 1): "%d.%m.%Y %H:%M",
+    ("-", 2): "%Y-%m-%d %H:%M:%S",
+    ("-", 0): "%Y-%m-%d",
+}
+
+
 def _parse_leads_created_after(raw: str) -> int:
     """Accept a Unix timestamp integer OR a human-readable date/time string (UTC).
 
@@ -245,11 +307,13 @@ def _parse_leads_created_after(raw: str) -> int:
         return 0
     if raw.isdigit():
         return int(raw)
-    for fmt in ("%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+    # The string's shape picks the one candidate format, so there is a single strptime.
+    fmt = _CREATED_AFTER_FORMATS.get(("." if "." in raw else "-", raw.count(":")))
+    if fmt:
         try:
             return int(datetime.strptime(raw, fmt).replace(tzinfo=timezone.utc).timestamp())
         except ValueError:
-            continue
+            pass
     _log.warning("LEADS_CREATED_AFTER='%s' is not a recognized format. Using 0.", raw)
     return 0
 
@@ -276,7 +340,7 @@ class Config:
     TRIGGER_STATUS_NAMES_EXTRA = os.getenv("TRIGGER_STATUS_NAMES", "").strip()
 
     STATUS_MAP = json.loads(os.getenv("DROPDOWN_STATUS_MAP_JSON", "{}"))
-    STATUS_ID_TO_NAME = {str(v): k for k, v in STATUS_MAP.items() if v}
+    STATUS_ID_TO_NAME = {int(v): k for k, v in STATUS_MAP.items() if v}
 
     SYNC_POLL_SECONDS = int(os.getenv("SYNC_POLL_SECONDS", "60"))
     # Sheet rotation interval: "monthly" (default) or "hourly" (useful for testing).
@@ -286,8 +350,25 @@ class Config:
     INITIAL_SYNC_DATE_TO   = os.getenv("INITIAL_SYNC_DATE_TO",   "").strip()
     # Minimum seconds between consecutive amoCRM API calls. Increase on prod if you see 429s.
     AMO_REQUEST_DELAY_SEC = float(os.getenv("AMO_REQUEST_DELAY_SEC", "0.08"))
+    # Token-bucket admission for AMO calls: sustained rate (requests/sec) and burst size.
+    # AMO allows 7 req/s per integration; when AMO_RATE_LIMIT_RPS is unset the rate is
+    # derived from AMO_REQUEST_DELAY_SEC so existing .env files keep their behaviour.
+    AMO_RATE_LIMIT_RPS = float(os.getenv("AMO_RATE_LIMIT_RPS", "0") or 0) or (
+        1.0 / AMO_REQUEST_DELAY_SEC if AMO_REQUEST_DELAY_SEC > 0 else 0.0
+    )
+    AMO_RATE_BURST = int(os.getenv("AMO_RATE_BURST", "7"))
+    # Client-side token bucket for Google Sheets write requests, sized to the
+    # 60 writes/min/user quota so bursts are smoothed before Google answers 429.
+    SHEETS_WRITES_PER_MIN = float(os.getenv("SHEETS_WRITES_PER_MIN", "60"))
+    SHEETS_WRITE_BURST = int(os.getenv("SHEETS_WRITE_BURST", "60"))
+    # Parallel workers pushing changed sheet rows to AMO in one poll cycle.  They all
+    # share AmoClient's token bucket, so this overlaps round-trips, not the rate.
+    SHEET_SYNC_WORKERS = int(os.getenv("SHEET_SYNC_WORKERS", "5"))
     # How long (seconds) the Staff sheet mapping is cached before re-fetching.
     STAFF_CACHE_TTL_SEC = int(os.getenv("STAFF_CACHE_TTL_SEC", "300"))
+    # How long (seconds) a Sheet status snapshot is reused by the Sheet → AMO poll.
+    # Our own sheet writes drop it immediately; only operator edits wait out the TTL.
+    SHEET_SNAPSHOT_TTL_SEC = float(os.getenv("SHEET_SNAPSHOT_TTL_SEC", "30"))
     # If the same (lead_id, status_id) webhook arrives again within this window, skip it.
     # Prevents repeated AMO API calls caused by amoCRM’s own webhook retry logic.
     WEBHOOK_DEDUP_TTL_SEC = int(os.getenv("WEBHOOK_DEDUP_TTL_SEC", "60"))
@@ -297,6 +378,9 @@ class Config:
     # Only process leads from pipelines whose name contains this keyword (case-insensitive).
     # New pipelines matching the keyword are picked up automatically. Empty = all pipelines.
     PIPELINE_KEYWORD = os.getenv("PIPELINE_KEYWORD", "").strip().lower()
+    # Upper bound on leads tracked in .sync_state.json.  Past it, the oldest finished
+    # leads on tabs the poller no longer scans are forgotten at the next flush.
+    STATE_MAX_TRACKED_LEADS = int(os.getenv("STATE_MAX_TRACKED_LEADS", "50000"))
     # Hours offset from UTC used when formatting timestamps for display in the Sheet.
     # Uzbekistan / Tashkent = 5 (UTC+5).  Set to 0 for UTC, 3 for Moscow, etc.
     DISPLAY_TZ_OFFSET = float(os.getenv("DISPLAY_TZ_OFFSET", "5"))
@@ -315,6 +399,21 @@ def require_env() -> None:
         raise RuntimeError(f"Missing required env vars: {', '.join(missing)}")
 
 
+@functools.lru_cache(maxsize=4096)
+def _fmt_ts(ts_int: int, include_time: bool, offset_sec: int) -> str:
+    """Format a Unix timestamp shifted by ``offset_sec``.
+
+    time.gmtime skips the tzinfo machinery of datetime.fromtimestamp, and formatting
+    its fields directly skips strftime's format parsing; the cache pays off because
+    leads in one batch share the same order/delivery dates.
+    """
+    t = time.gmtime(ts_int + offset_sec)
+    date = f"{t.tm_mday:02d}.{t.tm_mon:02d}.{t.tm_year}"
+    if include_time:
+        return f"{date} {t.tm_hour:02d}:{t.tm_min:02d}"
+    return date
+
+
 def _ts_to_date(ts, include_time: bool = False) -> str:
     """Convert a Unix timestamp to a display string in the configured timezone.
 
@@ -324,40 +423,180 @@ def _ts_to_date(ts, include_time: bool = False) -> str:
     if not ts:
         return ""
     try:
-        ts_int = int(float(ts))
+        # AMO's JSON API sends ints; only webhook form values need parsing.
+        ts_int = ts if isinstance(ts, int) else int(float(ts))
         if ts_int == 0:
             return ""
-        tz = timezone(timedelta(hours=Config.DISPLAY_TZ_OFFSET))
-        dt = datetime.fromtimestamp(ts_int, tz=tz)
-        return dt.strftime("%d.%m.%Y %H:%M") if include_time else dt.strftime("%d.%m.%Y")
+        return _fmt_ts(ts_int, include_time, int(Config.DISPLAY_TZ_OFFSET * 3600))
     except Exception:
         return ""
 
 
+# ── Retry / back-off for transient API errors ──────────────────────────────────
+# Exponential back-off with jitter: min(cap, base·2^attempt)·(1 + U(0, jitter)),
+# unless the server sent Retry-After, which always wins.
+
+_RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+_RETRY_MAX_ATTEMPTS = 5
+
+# Single-lead endpoint; PATCHes to it can be read back before a retry.
+_LEAD_ENDPOINT_RE = re.compile(r"/api/v4/leads/(\d+)")
+
+
+def _backoff_delay(
+    attempt: int,
+    retry_after: Optional[str] = None,
+    base: float = 1.0,
+    cap: float = 30.0,
+    jitter: float = 0.5,
+) -> float:
+    """Seconds to wait before retry number ``attempt`` (0-based)."""
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass  # HTTP-date form — fall back to computed back-off
+    return min(cap, base * (2 ** attempt)) * (1 + random.uniform(0, jitter))
+
+
+def _api_error_status(exc: "gspread.exceptions.APIError") -> int:
+    """HTTP status of a gspread APIError (``code`` is -1 when the body isn't JSON)."""
+    return exc.code if exc.code > 0 else getattr(exc.response, "status_code", exc.code)
+
+
+class AmoApiError(RuntimeError):
+    """An AMO API call that failed with an HTTP error after AmoClient's own retries."""
+
+    def __init__(self, message: str, status_code: int, retry_after: Optional[str] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def _retry_after(exc: Exception) -> Optional[str]:
+    """The server's Retry-After for a failed AMO or Sheets call, if it sent one."""
+    if isinstance(exc, AmoApiError):
+        return exc.retry_after
+    if isinstance(exc, gspread.exceptions.APIError) and exc.response is not None:
+        return exc.response.headers.get("Retry-After")
+    return None
+
+
+def _is_rate_limited(exc: Exception) -> bool:
+    """True for quota / rate-limit errors from gspread or AmoClient."""
+    if isinstance(exc, gspread.exceptions.APIError) and _api_error_status(exc) == 429:
+        return True
+    msg = str(exc)
+    return "429" in msg or "Quota exceeded" in msg
+
+
+def _retry_sheets_api(fn):
+    """Retry a SheetSync call on 429/5xx APIError with exponential back-off."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(_RETRY_MAX_ATTEMPTS):
+            try:
+                return fn(*args, **kwargs)
+            except gspread.exceptions.APIError as exc:
+                status = _api_error_status(exc)
+                if status not in _RETRYABLE_STATUS or attempt == _RETRY_MAX_ATTEMPTS - 1:
+                    raise
+                retry_after = exc.response.headers.get("Retry-After") if exc.response is not None else None
+                wait = _backoff_delay(attempt, retry_after)
+                _log.warning(
+                    "Sheets %d in %s — retrying in %.1fs (attempt %d/%d)",
+                    status, fn.__name__, wait, attempt + 1, _RETRY_MAX_ATTEMPTS,
+                )
+                time.sleep(wait)
+    return wrapper
+
+
+class TokenBucket:
+    """Thread-safe token bucket: bursts up to ``capacity``, refilled at ``rate`` tokens/s.
+
+    Starts full, so a cold burst is admitted at once; after that acquire()
+    blocks until one token has accrued.  ``rate <= 0`` disables limiting.
+
+    The lock only guards the arithmetic: a caller without credit reserves its
+    token (the balance goes negative) and sleeps outside the lock, so waiting
+    threads never queue behind one another's sleep just to read the balance.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens: float = float(self.capacity)
+        self._last_refill_ts: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last_refill_ts) * self.rate)
+            self._last_refill_ts = now
+            self._tokens -= 1
+            # Negative balance = tokens already promised to earlier waiters; ours
+            # accrues once that debt (plus our own token) has been refilled.
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def _atomic_write_bytes(path: Path, data: bytes) -> None:
+    """Replace ``path`` with ``data`` via a temp file that is fsynced before os.replace().
+
+    Readers see either the old file or the new one, never a partial write, and
+    the new content is on disk before the rename can survive a power loss.
+    """
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _atomic_write_text(path: Path, text: str) -> None:
+    """UTF-8 text variant of _atomic_write_bytes()."""
+    _atomic_write_bytes(path, text.encode("utf-8"))
+
+
 class TokenStore:
     def __init__(self, path: Path):
         self.path = path
         self.lock = threading.Lock()
+        # Parsed file contents, valid while the file's mtime is unchanged (the
+        # file can also be rewritten from outside, e.g. by setup scripts).
+        self._cached: Optional[Dict[str, str]] = None
+        self._cached_mtime_ns: int = 0
 
     def load(self) -> Dict[str, str]:
         with self.lock:
-            if not self.path.exists():
+            try:
+                mtime_ns = self.path.stat().st_mtime_ns
+            except FileNotFoundError:
                 return {
                     "access_token": os.getenv("AMO_ACCESS_TOKEN", ""),
                     "refresh_token": os.getenv("AMO_REFRESH_TOKEN", ""),
                 }
-            return json.loads(self.path.read_text(encoding="utf-8"))
+            if self._cached is None or mtime_ns != self._cached_mtime_ns:
+                self._cached = json.loads(self.path.read_text(encoding="utf-8"))
+                self._cached_mtime_ns = mtime_ns
+            return dict(self._cached)
 
     def save(self, access_token: str, refresh_token: str) -> None:
+        """Write both tokens atomically (temp file + os.replace).
+
+        A crash mid-write must never leave a truncated token file: the refresh
+        token in it is single-use and cannot be recovered from AMO.
+        """
+        data = {"access_token": access_token, "refresh_token": refresh_token}
         with self.lock:
-            self.path.write_text(
-                json.dumps(
-                    {"access_token": access_token, "refresh_token": refresh_token},
-                    ensure_ascii=False,
-                    indent=2,
-                ),
-                encoding="utf-8",
-            )
+            _atomic_write_text(self.path, json.dumps(data, ensure_ascii=False, indent=2))
+            self._cached = data
+            self._cached_mtime_ns = self.path.stat().st_mtime_ns
 
 
 class AmoClient:
@@ -365,44 +604,67 @@ class AmoClient:
         self.cfg = cfg
         self.token_store = token_store
         self.base_url = f"https://{cfg.AMO_SUBDOMAIN}.amocrm.ru"
-        # Per-call throttle state
-        self._last_request_ts: float = 0.0
-        self._req_lock = threading.Lock()
-        # Token cache – avoids a /account ping before every API call
+        self._bucket = TokenBucket(cfg.AMO_RATE_LIMIT_RPS, cfg.AMO_RATE_BURST)
+        # One keep-alive pool for every AMO call: skips a TCP+TLS handshake per
+        # request. Retries stay in _api_request, so the adapter never retries.
+        self.session = requests.Session()
+        self.session.mount(
+            "https://", HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=0)
+        )
+        # Token cache – no AMO round-trip to obtain or check a token until it
+        # expires (monotonic deadline) or AMO answers 401.
         self._cached_access_token: str = ""
-        self._token_validated_ts: float = 0.0
+        self._token_expires_at: float = 0.0
+        # Serialises validation/refresh: AMO refresh tokens are single-use, so two
+        # threads refreshing at once would leave one of them with a dead token.
+        self._token_lock = threading.Lock()
 
     def _throttle(self) -> None:
-        """Enforce a minimum gap between consecutive AMO API calls."""
-        delay = self.cfg.AMO_REQUEST_DELAY_SEC
-        if delay <= 0:
-            return
-        with self._req_lock:
-            elapsed = time.time() - self._last_request_ts
-            if elapsed < delay:
-                time.sleep(delay - elapsed)
-            self._last_request_ts = time.time()
-
-    def _api_request(self, method: str, url: str, headers: Dict, **kwargs) -> requests.Response:
-        """Execute an AMO API call with throttle and automatic 429 back-off retry."""
-        for attempt in range(1, 6):
+        """Token-bucket admission: bursts up to AMO_RATE_BURST, refilled at AMO_RATE_LIMIT_RPS.
+
+        Idle time accumulates credit (capped at the burst size), so a webhook spike
+        goes out immediately instead of being spaced at a fixed minimum gap.
+        """
+        self._bucket.acquire()
+
+    def _api_request(
+        self,
+        method: str,
+        url: str,
+        headers: Dict,
+        already_applied: Optional[Callable[[], bool]] = None,
+        **kwargs,
+    ) -> requests.Response:
+        """Execute an AMO API call with throttle and back-off retry on 429/5xx.
+
+        A 5xx on a write may still have been applied server-side. When
+        ``already_applied`` is given it is asked before each 5xx retry, and a True
+        answer ends the loop instead of sending the write a second time.
+        """
+        for attempt in range(_RETRY_MAX_ATTEMPTS):
             self._throttle()
             t0 = time.monotonic()
-            r = requests.request(method, url, headers=headers, timeout=30, **kwargs)
+            r = self.session.request(method, url, headers=headers, timeout=30, **kwargs)
             elapsed_ms = int((time.monotonic() - t0) * 1000)
             # Strip base URL for brevity in logs
             short_url = url.replace(self.base_url, "")
-            if r.status_code == 429:
-                wait = min(attempt * 10, 60)
+            if r.status_code in _RETRYABLE_STATUS and attempt < _RETRY_MAX_ATTEMPTS - 1:
+                if r.status_code != 429 and already_applied is not None and already_applied():
+                    _log_amo.warning(
+                        "AMO %d %s %s — change already applied, not retrying",
+                        r.status_code, method, short_url,
+                    )
+                    return r
+                wait = _backoff_delay(attempt, r.headers.get("Retry-After"))
                 _log_amo.warning(
-                    "AMO 429 %s %s — retrying in %ds (attempt %d/5)",
-                    method, short_url, wait, attempt,
+                    "AMO %d %s %s — retrying in %.1fs (attempt %d/%d)",
+                    r.status_code, method, short_url, wait, attempt + 1, _RETRY_MAX_ATTEMPTS,
                 )
                 time.sleep(wait)
                 continue
             _log_amo.debug("%s %s → %d (%dms)", method, short_url, r.status_code, elapsed_ms)
             return r
-        return r  # return last response after exhausting retries
+        return r  # unreachable: the last attempt always returns above
 
     def auth_url(self) -> str:
         return (
@@ -419,17 +681,22 @@ class AmoClient:
     def _headers(self, access_token: str) -> Dict[str, str]:
         return {"Authorization": f"Bearer {access_token}"}
 
-    def _is_token_valid(self, access_token: str) -> bool:
-        if not access_token:
-            return False
-        r = requests.get(
-            f"{self.base_url}/api/v4/account",
-            headers=self._headers(access_token),
-            timeout=20,
-        )
-        return r.status_code == 200
+    # Lifetime assumed for a token read from the token store (its age is unknown;
+    # AMO tokens are valid for 24 h) and the safety margin taken off a known expiry.
+    _TOKEN_CACHE_SEC = 82800
+    _TOKEN_EXPIRY_MARGIN_SEC = 60
 
-    def _refresh(self, refresh_token: str) -> str:
+    def _cache_token(self, access_token: str, expires_in: Any = None) -> str:
+        """Cache ``access_token`` until ``expires_in`` seconds from now (minus a margin)."""
+        lifetime = _to_int(expires_in) - self._TOKEN_EXPIRY_MARGIN_SEC if expires_in else self._TOKEN_CACHE_SEC
+        self._cached_access_token = access_token
+        self._token_expires_at = time.monotonic() + max(lifetime, 0)
+        return access_token
+
+    def _token_cached(self) -> bool:
+        return bool(self._cached_access_token) and time.monotonic() < self._token_expires_at
+
+    def _refresh(self, refresh_token: str) -> Dict[str, Any]:
         if not refresh_token:
             raise RuntimeError("No refresh token found. Complete OAuth first.")
 
@@ -440,7 +707,7 @@ class AmoClient:
             "refresh_token": refresh_token,
             "redirect_uri": self.cfg.AMO_REDIRECT_URI,
         }
-        r = requests.post(
+        r = self.session.post(
             f"{self.base_url}/oauth2/access_token",
             json=payload,
             timeout=30,
@@ -450,37 +717,56 @@ class AmoClient:
 
         data = r.json()
         self.token_store.save(data["access_token"], data["refresh_token"])
-        return data["access_token"]
+        return data
 
     def get_access_token(self) -> str:
-        # Re-use cached token for up to 23 hours — AMO tokens are valid for 24 h.
-        # The refresh_token path handles the rare case of an expired token.
-        now = time.time()
-        if self._cached_access_token and now - self._token_validated_ts < 82800:
+        # Re-use the cached token until shortly before it expires; a 401 from AMO
+        # before then goes through _renew_access_token instead.
+        if self._token_cached():
             return self._cached_access_token
-
+        with self._token_lock:
+            # Another thread may have refreshed while we waited for the lock.
+            if self._token_cached():
+                return self._cached_access_token
+            # An expired cache entry is refreshed, not re-read from the store.
+            return self._load_or_refresh_token(rejected=self._cached_access_token)
+
+    def _renew_access_token(self, rejected: str) -> str:
+        """Drop ``rejected`` (answered 401 by AMO) and return a working token.
+
+        Only the first thread to report a given token clears the cache; threads
+        that were rejected with the same token afterwards find a fresh one already
+        cached and reuse it instead of refreshing again (AMO refresh tokens are
+        single-use).
+        """
+        with self._token_lock:
+            if self._token_cached() and self._cached_access_token != rejected:
+                return self._cached_access_token
+            return self._load_or_refresh_token(rejected=rejected)
+
+    def _load_or_refresh_token(self, rejected: str = "") -> str:
+        """Cache and return the stored access token, or refresh it when there is
+        none or it is ``rejected`` (already answered 401 or expired).
+
+        A stored token is trusted without a probe request; if it turns out to be
+        dead, the 401 on first use brings us back here with it as ``rejected``.
+        Call with _token_lock held.
+        """
         tokens = self._token_data()
         access_token = tokens.get("access_token", "")
         refresh_token = tokens.get("refresh_token", "")
 
-        if self._is_token_valid(access_token):
-            self._cached_access_token = access_token
-            self._token_validated_ts = now
-            return access_token
+        if access_token and access_token != rejected:
+            return self._cache_token(access_token)
         if not refresh_token and self.cfg.AMO_AUTH_CODE:
             _log.info("No refresh token found, trying AMO_AUTH_CODE bootstrap...")
             try:
                 data = self.exchange_code(self.cfg.AMO_AUTH_CODE)
-                token = data["access_token"]
-                self._cached_access_token = token
-                self._token_validated_ts = time.time()
-                return token
+                return data["access_token"]
             except Exception as exc:
                 raise RuntimeError(f"AMO_AUTH_CODE bootstrap failed: {exc}")
-        token = self._refresh(refresh_token)
-        self._cached_access_token = token
-        self._token_validated_ts = time.time()
-        return token
+        data = self._refresh(refresh_token)
+        return self._cache_token(data["access_token"], data.get("expires_in"))
 
     def exchange_code(self, code_or_redirect_url: str) -> Dict[str, Any]:
         value = (code_or_redirect_url or "").strip()
@@ -509,36 +795,46 @@ class AmoClient:
             "code": code,
             "redirect_uri": self.cfg.AMO_REDIRECT_URI,
         }
-        r = requests.post(f"{self.base_url}/oauth2/access_token", json=payload, timeout=30)
+        r = self.session.post(f"{self.base_url}/oauth2/access_token", json=payload, timeout=30)
         if r.status_code != 200:
             raise RuntimeError(f"OAuth exchange failed: {r.status_code} {r.text}")
 
         data = r.json()
         self.token_store.save(data["access_token"], data["refresh_token"])
+        self._cache_token(data["access_token"], data.get("expires_in"))
         return data
 
     def get(self, endpoint: str) -> Dict[str, Any]:
         token = self.get_access_token()
         r = self._api_request("GET", f"{self.base_url}{endpoint}", self._headers(token))
-        if r.status_code == 204 or not r.text:
+        if r.status_code == 401:
+            # Token revoked/expired before our 23 h cache window ran out.
+            token = self._renew_access_token(token)
+            r = self._api_request("GET", f"{self.base_url}{endpoint}", self._headers(token))
+        # Work on r.content: AMO's hal+json carries no charset, so every r.text /
+        # r.json() would first run charset detection over the whole body.
+        # json.loads reads UTF-8 bytes directly.
+        if r.status_code == 204 or not r.content:
             return {}
         if r.status_code >= 400:
             _log_amo.error("GET %s failed: %d %s", endpoint, r.status_code, r.text[:200])
-            raise RuntimeError(f"GET {endpoint} failed: {r.status_code} {r.text}")
-        return r.json()
+            raise AmoApiError(
+                f"GET {endpoint} failed: {r.status_code} {r.text}", r.status_code, r.headers.get("Retry-After"),
+            )
+        return json.loads(r.content)
 
     def batch_get_leads(self, lead_ids: List[int]) -> Dict[int, Dict[str, Any]]:
         """Fetch multiple leads in one request. Returns {lead_id: lead_data}.
 
-        Uses filter[id][] to batch up to 50 leads per request, reducing per-lead
-        GET calls from N down to ceil(N/50).  Any chunk that fails is logged and
+        Uses filter[id][] to batch up to 250 leads (AMO's page-size cap) per
+        request, reducing per-lead GET calls from N down to ceil(N/250).  Any chunk that fails is logged and
         its IDs are simply absent from the result — callers fall back to the
         original webhook payload for those leads.
         """
         if not lead_ids:
             return {}
         result: Dict[int, Dict[str, Any]] = {}
-        CHUNK = 50
+        CHUNK = 250
         for i in range(0, len(lead_ids), CHUNK):
             chunk = lead_ids[i : i + CHUNK]
             ids_param = "&".join(f"filter[id][]={lid}" for lid in chunk)
@@ -555,6 +851,11 @@ class AmoClient:
                 )
         return result
 
+    # Date-range pages iter_lead_pages_by_date_range requests speculatively, beyond
+    # the next page AMO has confirmed — at most this many requests are wasted past
+    # the last page.
+    _PAGE_PREFETCH = 1
+
     def fetch_leads_by_date_range(
         self, date_from: str, date_to: str
     ) -> List[Dict[str, Any]]:
@@ -562,6 +863,15 @@ class AmoClient:
 
         Pages through the full result set automatically.
         """
+        return [lead for page in self.iter_lead_pages_by_date_range(date_from, date_to) for lead in page]
+
+    def iter_lead_pages_by_date_range(
+        self, date_from: str, date_to: str
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """Yield the leads created in [date_from, date_to] one AMO page (≤250) at a time.
+
+        Lets callers process a large range page by page instead of holding it all.
+        """
         try:
             ts_from = int(datetime.strptime(date_from, "%Y-%m-%d").timestamp())
             # Include the entire last day (up to 23:59:59).
@@ -569,30 +879,50 @@ class AmoClient:
         except ValueError as exc:
             raise RuntimeError(f"Invalid date format (expected YYYY-MM-DD): {exc}")
 
-        all_leads: List[Dict[str, Any]] = []
-        page = 1
-        while True:
-            endpoint = (
-                f"/api/v4/leads"
-                f"?filter[created_at][from]={ts_from}"
-                f"&filter[created_at][to]={ts_to}"
-                f"&limit=250&page={page}"
-            )
+        PAGE_SIZE = 250
+
+        def _fetch_page(page: int) -> Dict[str, Any]:
             try:
-                data = self.get(endpoint)
+                return self.get(
+                    f"/api/v4/leads"
+                    f"?filter[created_at][from]={ts_from}"
+                    f"&filter[created_at][to]={ts_to}"
+                    f"&limit={PAGE_SIZE}&page={page}"
+                )
             except RuntimeError as exc:
                 if "204" in str(exc) or "No Content" in str(exc):
-                    break  # AMO returns 204 when there are no more pages
+                    return {}  # AMO returns 204 when there are no more pages
                 raise
-            leads = (data.get("_embedded") or {}).get("leads") or []
-            if not leads:
-                break
-            all_leads.extend(leads)
-            # AMO paginates with _links.next; stop when it is absent.
-            if not (data.get("_links") or {}).get("next"):
-                break
-            page += 1
-        return all_leads
+
+        # Page 1 alone first (most ranges fit in it).  Once a page reports another,
+        # that page is requested together with _PAGE_PREFETCH speculative ones
+        # beyond it.  The token bucket still paces the actual requests; pages are
+        # consumed strictly in order.
+        pool = ThreadPoolExecutor(max_workers=self._PAGE_PREFETCH + 1, thread_name_prefix="amo-pages")
+        inflight = {1: pool.submit(_fetch_page, 1)}
+        next_page = 2
+        page = 1
+        try:
+            while True:
+                data = inflight.pop(page).result()
+                leads = (data.get("_embedded") or {}).get("leads") or []
+                if not leads:
+                    break
+                # AMO paginates with _links.next; a short page is the last one too.
+                has_next = len(leads) >= PAGE_SIZE and bool((data.get("_links") or {}).get("next"))
+                if has_next:
+                    page += 1
+                    while next_page <= page + self._PAGE_PREFETCH:
+                        inflight[next_page] = pool.submit(_fetch_page, next_page)
+                        next_page += 1
+                # Later pages keep downloading while the caller handles this one.
+                yield leads
+                if not has_next:
+                    break
+        finally:
+            # Speculative pages past the end (or after the caller stopped) are not
+            # needed: drop the queued ones and don't block on those already running.
+            pool.shutdown(wait=False, cancel_futures=True)
 
     def fetch_order_event_lead_ids(
         self,
@@ -612,7 +942,10 @@ class AmoClient:
             consul  = leads created on date
             zakas   = leads created on date that became orders on that same date
         """
-        events: List[Dict[str, Any]] = []
+        # Each page is reduced as soon as it arrives, so at most one page of
+        # events is held in memory.
+        result: set = set()
+        order_ids = frozenset(order_status_ids)
         page = 1
         while True:
             endpoint = (
@@ -631,41 +964,89 @@ class AmoClient:
             batch = (data.get("_embedded") or {}).get("events") or []
             if not batch:
                 break
-            events.extend(batch)
+            add = result.add
+            for ev in batch:
+                # Most status changes are not into an order stage: test the
+                # target status first and only then look at the previous one.
+                after = ev.get("value_after")
+                if not after:
+                    continue
+                new_sid = _to_int((after[0].get("lead_status") or {}).get("id"))
+                if new_sid not in order_ids:
+                    continue
+                before  = (ev.get("value_before") or [{}])[0]
+                old_sid = _to_int((before.get("lead_status") or {}).get("id"))
+                if old_sid not in order_ids:
+                    add(_to_int(ev.get("entity_id")))
             if not (data.get("_links") or {}).get("next"):
                 break
             page += 1
 
-        first_entry: Dict[int, int] = {}  # lead_id -> earliest event ts
-        for ev in events:
-            lead_id  = int(ev.get("entity_id", 0) or 0)
-            before   = (ev.get("value_before") or [{}])[0]
-            after    = (ev.get("value_after")  or [{}])[0]
-            old_sid  = int((before.get("lead_status") or {}).get("id", 0) or 0)
-            new_sid  = int((after.get("lead_status")  or {}).get("id", 0) or 0)
-            if new_sid in order_status_ids and old_sid not in order_status_ids:
-                ev_ts = int(ev.get("created_at", 0) or 0)
-                if lead_id not in first_entry or ev_ts < first_entry[lead_id]:
-                    first_entry[lead_id] = ev_ts
-
-        result = set(first_entry.keys())
         if created_lead_ids is not None:
             result &= created_lead_ids
         return result
 
+    def _lead_patch_applied(self, endpoint: str, body: Dict[str, Any]) -> bool:
+        """True when the lead at ``endpoint`` already holds every value in ``body``.
+
+        amoCRM has no idempotency keys, so this read-back is what keeps a retried
+        PATCH from moving a lead twice (and firing its automations twice).
+        """
+        if not _LEAD_ENDPOINT_RE.fullmatch(endpoint):
+            return False
+        try:
+            lead = self.get(endpoint)
+        except Exception:
+            return False
+        for key in ("status_id", "pipeline_id"):
+            if key in body and _to_int(lead.get(key)) != _to_int(body[key]):
+                return False
+        current = {
+            cf.get("field_id"): [v.get("value") for v in cf.get("values") or []]
+            for cf in lead.get("custom_fields_values") or []
+        }
+        for cf in body.get("custom_fields_values") or []:
+            # Clearing a field (value "") removes it from the lead entirely.
+            wanted = [v.get("value") for v in cf.get("values") or [] if v.get("value") not in ("", None)]
+            if current.get(cf.get("field_id"), []) != wanted:
+                return False
+        return True
+
     def patch(self, endpoint: str, body: Dict[str, Any]) -> Dict[str, Any]:
         token = self.get_access_token()
         _log_amo.debug("PATCH %s  body=%s", endpoint, json.dumps(body, ensure_ascii=False)[:300])
+        applied = False
+
+        def _already_applied() -> bool:
+            nonlocal applied
+            applied = self._lead_patch_applied(endpoint, body)
+            return applied
+
         r = self._api_request(
             "PATCH",
             f"{self.base_url}{endpoint}",
             {**self._headers(token), "Content-Type": "application/json"},
+            already_applied=_already_applied,
             json=body,
         )
+        if r.status_code == 401:
+            # Rejected before processing, so resending with a fresh token is safe.
+            token = self._renew_access_token(token)
+            r = self._api_request(
+                "PATCH",
+                f"{self.base_url}{endpoint}",
+                {**self._headers(token), "Content-Type": "application/json"},
+                already_applied=_already_applied,
+                json=body,
+            )
+        if applied:
+            return {}
         if r.status_code >= 400:
             _log_amo.error("PATCH %s failed: %d %s", endpoint, r.status_code, r.text[:200])
-            raise RuntimeError(f"PATCH {endpoint} failed: {r.status_code} {r.text}")
-        return r.json() if r.text else {}
+            raise AmoApiError(
+                f"PATCH {endpoint} failed: {r.status_code} {r.text}", r.status_code, r.headers.get("Retry-After"),
+            )
+        return json.loads(r.content) if r.content else {}
 
 
 class SheetSync:
@@ -674,26 +1055,41 @@ class SheetSync:
         self.gc = gspread.service_account(filename=cfg.GOOGLE_SERVICE_ACCOUNT_FILE)
         self.spreadsheet = self.gc.open_by_key(cfg.GOOGLE_SHEET_ID)
         self.lock = threading.Lock()
+        # One write bucket per process, shared by the webhook worker and the poller.
+        self._write_bucket = TokenBucket(cfg.SHEETS_WRITES_PER_MIN / 60.0, cfg.SHEETS_WRITE_BURST)
         # Cache of worksheet objects keyed by tab name
         self._sheets: Dict[str, Any] = {}
         # Staff mapping cache – refreshed every STAFF_CACHE_TTL_SEC seconds
         self._staff_cache: Dict[str, str] = {}
         self._staff_cache_ts: float = 0.0
         # In-memory row index: ws_name → {lead_id → 1-based row number}
-        # A single get_all_values() builds the index; all subsequent find_row / upsert
+        # One read of the ID column builds the index; all subsequent find_row / upsert
         # calls are O(1) dict lookups with no additional Sheets API calls.
-        self._row_index: Dict[str, Dict[str, int]] = {}
+        self._row_index: Dict[str, Dict[int, int]] = {}
         self._row_count: Dict[str, int] = {}  # ws_name → last occupied row number
         # Cache of worksheet titles — refreshed at most once every 120 s to avoid
         # a metadata fetch on every poll cycle.
         self._ws_titles_cache: List[str] = []
         self._ws_titles_ts: float = 0.0
+        # Last iter_lead_statuses() result: (monotonic ts, tabs_filter, rows,
+        # Drive modifiedTime seen before the read).  Cleared by every write this
+        # class makes to the sheet.
+        self._status_snapshot: Optional[
+            Tuple[float, Optional[frozenset], List[Dict[str, str]], Optional[str]]
+        ] = None
+        # Bumped by every invalidation: a read that overlapped a write sees a
+        # different generation at the end and does not store its stale rows.
+        self._snapshot_gen: int = 0
+        self._snapshot_lock = threading.Lock()
+        # ws_name → last row covered by the status dropdown.  New rows beyond it
+        # extend validation in _VALIDATION_EXTEND_ROWS blocks, not per insert.
+        self._validation_last_row: Dict[str, int] = {}
 
     def _get_or_create_sheet(self, name: str):
         if name in self._sheets:
             return self._sheets[name]
-        # Always re-fetch spreadsheet metadata first to avoid stale cache issues
-        self.spreadsheet = self.gc.open_by_key(self.cfg.GOOGLE_SHEET_ID)
+        # worksheet() reads fresh spreadsheet metadata itself, so the handle from
+        # __init__ never goes stale and needs no re-open here.
         try:
             ws = self.spreadsheet.worksheet(name)
         except gspread.WorksheetNotFound:
@@ -709,8 +1105,8 @@ class SheetSync:
                 self._invalidate_row_index(name)
                 # Apply dropdown only when creating/resetting the sheet so we
                 # don't overwrite existing Google Sheets validation on every restart.
-                status_col_letter = chr(ord("A") + STATUS_COL_INDEX)
-                self._apply_status_dropdown(ws, f"{status_col_letter}2:{status_col_letter}2000")
+                self._apply_status_dropdown(ws, f"{STATUS_COL_LETTER}2:{STATUS_COL_LETTER}2000")
+                self._validation_last_row[name] = 2000
                 
         self._sheets[name] = ws
         return ws
@@ -724,10 +1120,8 @@ class SheetSync:
         """
         if tab_name in self._sheets:
             return self._sheets[tab_name]
-        # Re-fetch spreadsheet metadata to avoid stale cache issues
-        self.spreadsheet = self.gc.open_by_key(self.cfg.GOOGLE_SHEET_ID)
         try:
-            ws = self.spreadsheet.worksheet(tab_name)
+            ws = self.spreadsheet.worksheet(tab_name)  # fresh metadata, no re-open needed
         except gspread.WorksheetNotFound:
             ws = self.spreadsheet.add_worksheet(title=tab_name, rows=2000, cols=max(26, len(COLUMNS)))
         # Ensure column headers are in place
@@ -738,8 +1132,8 @@ class SheetSync:
             self._invalidate_row_index(tab_name)
             # Apply dropdown only when creating/resetting the sheet so we
             # don't overwrite existing Google Sheets validation on every restart.
-            status_col_letter = chr(ord("A") + STATUS_COL_INDEX)
-            self._apply_status_dropdown(ws, f"{status_col_letter}2:{status_col_letter}2000")
+            self._apply_status_dropdown(ws, f"{STATUS_COL_LETTER}2:{STATUS_COL_LETTER}2000")
+            self._validation_last_row[tab_name] = 2000
         self._sheets[tab_name] = ws
         return ws
 
@@ -762,6 +1156,8 @@ class SheetSync:
             # Invalidate row indices for both old and new tab names
             self._invalidate_row_index(main_name)
             self._invalidate_row_index(archive_tab_name)
+            self._validation_last_row.pop(main_name, None)
+            self._validation_last_row.pop(archive_tab_name, None)
             # Create (or re-open) a new active sheet with headers + dropdown
             self._get_or_create_sheet(main_name)
             _log.info("New active worksheet '%s' created for the new month.", main_name)
@@ -782,12 +1178,8 @@ class SheetSync:
                     name = str(row[2]).strip()
                     if code and name:
                         # Store with and without leading zeros for flexible matching
-                        try:
-                            code_int = str(int(code))
-                        except ValueError:
-                            code_int = code
-                        mapping[code] = name        # e.g. "0134" → name
-                        mapping[code_int] = name    # e.g. "134"  → name
+                        mapping[code] = name              # e.g. "0134" → name
+                        mapping[_norm_code(code)] = name  # e.g. "134"  → name
             self._staff_cache = mapping
             self._staff_cache_ts = now
             return mapping
@@ -805,6 +1197,7 @@ class SheetSync:
         e.g. ``"T2:T2000"`` or ``"T5:T5"``.
         """
         try:
+            self._write_bucket.acquire()
             ws.add_validation(
                 row_range,
                 ValidationConditionType.one_of_list,
@@ -814,11 +1207,23 @@ class SheetSync:
         except Exception as e:
             _log.warning("Could not set dropdown validation on %s: %s", row_range, e)
 
-    def _all_rows(self, ws) -> List[List[str]]:
-        values = ws.get_all_values()
-        if not values:
-            return []
-        return values[1:]
+    _VALIDATION_EXTEND_ROWS = 500
+
+    def _ensure_status_dropdown(self, ws, row: int, last_row: int = 0) -> None:
+        """Make sure the status dropdown covers rows *row*..*last_row*, extending it in blocks.
+
+        A whole appended block costs at most one add_validation call.  Tabs opened
+        after a restart have an unknown high-water mark, so their first insert
+        re-applies the (identical) rule once from that row on.
+        """
+        covered = self._validation_last_row.get(ws.title, 0)
+        last_row = max(row, last_row)
+        if last_row <= covered:
+            return
+        first = max(row, covered + 1)
+        last = last_row + self._VALIDATION_EXTEND_ROWS
+        self._apply_status_dropdown(ws, f"{STATUS_COL_LETTER}{first}:{STATUS_COL_LETTER}{last}")
+        self._validation_last_row[ws.title] = last
 
     # ── Row index cache ───────────────────────────────────────────────────────
     # Eliminates repeated get_all_values() calls.  Built once per worksheet on
@@ -868,23 +1273,20 @@ class SheetSync:
                    if i + 1 not in set(empty)]
         return cleaned
 
-    def _purge_duplicate_rows(self, ws, ws_name: str, all_vals: List[Any]) -> List[Any]:
+    def _purge_duplicate_rows(self, ws, ws_name: str, ids: List[str]) -> List[str]:
         """Delete rows where the same lead ID appears more than once, keeping the LAST
         occurrence so the in-memory row index stays consistent with what we update later.
 
-        Called once at cold-start (or index rebuild) from _build_row_index, right after
-        _purge_empty_rows.  Deletions run in reverse row-number order to avoid index
-        shifting.  Returns the cleaned list of rows.
+        ``ids`` holds the stripped ID cell of every sheet row (index 0 = header).
+        Called once at cold-start (or index rebuild) from _build_row_index, after any
+        empty-row purge.  Deletions run in reverse row-number order to avoid index
+        shifting.  Returns the cleaned ID list.
         """
         # Map lead_id → list of ALL 1-based row indices where it appears
         occurrences: Dict[str, List[int]] = {}
-        for i, row in enumerate(all_vals):
-            if i == 0:
-                continue  # skip header
-            if len(row) > ID_COL_INDEX:
-                lid = str(row[ID_COL_INDEX]).strip()
-                if lid:
-                    occurrences.setdefault(lid, []).append(i + 1)  # 1-based index in all_vals
+        for i, lid in enumerate(ids):
+            if i and lid:  # skip header
+                occurrences.setdefault(lid, []).append(i + 1)  # 1-based row number
 
         # Collect row indices to remove (all but the last occurrence per lead_id)
         to_delete: set = set()
@@ -898,7 +1300,7 @@ class SheetSync:
                 to_delete.update(earlier)
 
         if not to_delete:
-            return all_vals
+            return ids
 
         # Delete from highest row to lowest so that row indices below each deletion
         # remain valid throughout the loop.
@@ -908,35 +1310,36 @@ class SheetSync:
         _log_lead.info("SHEET '%s': purged %d duplicate lead row(s).", ws_name, len(to_delete))
 
         # Return a cleaned list (keeps rows whose 1-based index is NOT in to_delete)
-        return [row for i, row in enumerate(all_vals) if (i + 1) not in to_delete]
+        return [lid for i, lid in enumerate(ids) if (i + 1) not in to_delete]
 
     def _build_row_index(self, ws, ws_name: str) -> None:
-        """Read the sheet once, purge empty + duplicate rows, then build lead_id → row mapping."""
-        all_vals = ws.get_all_values()
+        """Read the ID column, purge empty + duplicate rows, then build lead_id → row mapping.
 
-        # Remove blank rows left over from manual sheet clears.
-        all_vals = self._purge_empty_rows(ws, ws_name, all_vals)
+        Only the ID column is downloaded.  A blank ID inside the data range may be
+        a fully blank row left by a manual sheet clear, which only the full row can
+        tell, so in that case the whole sheet is read once and purged as before.
+        """
+        col = ws.get(f"{ID_COL_LETTER}1:{ID_COL_LETTER}", major_dimension="COLUMNS")
+        ids = [str(v).strip() for v in (col[0] if col else [])]
+        while ids and not ids[-1]:
+            ids.pop()
+
+        if "" in ids[1:]:
+            # Remove blank rows left over from manual sheet clears.
+            all_vals = self._purge_empty_rows(ws, ws_name, ws.get_all_values())
+            ids = [
+                str(row[ID_COL_INDEX]).strip() if len(row) > ID_COL_INDEX else ""
+                for row in all_vals
+            ]
         # Remove duplicate lead-ID rows (keep last occurrence per ID).
-        all_vals = self._purge_duplicate_rows(ws, ws_name, all_vals)
-
-        idx: Dict[str, int] = {}
-        last_data_row = 0
-        for i, row in enumerate(all_vals):
-            if any(str(cell).strip() for cell in row):
-                last_data_row = i + 1  # track last row with any content
-            if i == 0:
-                continue  # skip header
-            if len(row) > ID_COL_INDEX:
-                lid = str(row[ID_COL_INDEX]).strip()
-                if lid:
-                    idx[lid] = i + 1  # 1-based row number
-        self._row_index[ws_name] = idx
-        # Use the last *non-empty* row so that blank rows left over from a
-        # manual sheet clear are not counted — new data will fill from
-        # directly after the last real row instead of after the blanks.
-        self._row_count[ws_name] = last_data_row
-
-    def _get_row_index(self, ws, ws_name: str) -> Dict[str, int]:
+        ids = self._purge_duplicate_rows(ws, ws_name, ids)
+
+        self._row_index[ws_name] = {int(lid): i + 1 for i, lid in enumerate(ids) if i and lid.isdigit()}
+        # Blank rows are gone by now, so the last real row is the end of the list:
+        # new data fills from directly after it instead of after leftover blanks.
+        self._row_count[ws_name] = len(ids)
+
+    def _get_row_index(self, ws, ws_name: str) -> Dict[int, int]:
         if ws_name not in self._row_index:
             self._build_row_index(ws, ws_name)
         return self._row_index[ws_name]
@@ -945,65 +1348,174 @@ class SheetSync:
         """Discard cached index so it is rebuilt on next access."""
         self._row_index.pop(ws_name, None)
         self._row_count.pop(ws_name, None)
+        self._drop_status_snapshot()
 
-    def find_row(self, ws, lead_id: str) -> Optional[int]:
-        """O(1) row lookup via in-memory index (cold start: one get_all_values())."""
-        return self._get_row_index(ws, ws.title).get(str(lead_id))
+    def _drop_status_snapshot(self) -> None:
+        """Forget the iter_lead_statuses() snapshot and any read still in flight."""
+        with self._snapshot_lock:
+            self._snapshot_gen += 1
+            self._status_snapshot = None
 
-    def upsert_row(self, row_data: List[Any], tab_name: str) -> int:
-        ws = self._get_or_create_month_sheet(tab_name)
-        lead_id = str(row_data[ID_COL_INDEX])
-        ws_name = ws.title
-        with self.lock:
-            row_idx = self._get_row_index(ws, ws_name)
-            row_num = row_idx.get(lead_id)
-            if row_num:
-                ws.update(values=[row_data], range_name=f"A{row_num}")
-                _log_lead.info("SHEET UPDATE row=%d lead=%s tab='%s'", row_num, lead_id, ws_name)
-                return row_num
-
-            # Use append_rows instead of a position-specific update so that the row
-            # is always placed directly after the last real data row on the sheet,
-            # regardless of whether _row_count is stale (e.g. after an external
-            # manual deletion).  This prevents gaps / empty rows from accumulating.
-            result = ws.append_rows(
-                [row_data],
-                value_input_option="USER_ENTERED",
-                insert_data_option="INSERT_ROWS",
-            )
-            # Parse the actual row number from the API response:
-            # result["updates"]["updatedRange"] = "SheetName!A51:T51"
-            actual_row: int = self._row_count.get(ws_name, 1) + 1  # safe fallback
-            try:
-                updated_range = result.get("updates", {}).get("updatedRange", "")
-                # Extract the START row from a range like "Sheet1!A51:T51" or "A51:T51"
-                m = re.search(r"[A-Za-z](\d+):", updated_range)
-                if m:
-                    actual_row = int(m.group(1))
-            except Exception:
-                pass  # Keep fallback value
-
-            # Keep index consistent
-            row_idx[lead_id] = actual_row
-            self._row_count[ws_name] = actual_row
-            _log_lead.info("SHEET INSERT row=%d lead=%s tab='%s'", actual_row, lead_id, ws_name)
-            # Apply a dropdown to the status cell of the new row
-            status_col_letter = chr(ord("A") + STATUS_COL_INDEX)
-            self._apply_status_dropdown(ws, f"{status_col_letter}{actual_row}:{status_col_letter}{actual_row}")
-            return actual_row
-
-    def update_status(self, lead_id: str, status_name: str, tab_name: str = "") -> None:
-        ws = self._get_or_create_month_sheet(tab_name or datetime.now().strftime("%m.%Y"))
-        with self.lock:
-            row_num = self.find_row(ws, lead_id)
-            if not row_num:
-                _log_lead.warning("SHEET STATUS — lead %s not found in tab '%s'", lead_id, tab_name)
-                return
-            col = STATUS_COL_INDEX + 1
-            ws.update_cell(row_num, col, status_name)
-            _log_lead.info("SHEET STATUS lead=%s → '%s' (row=%d tab='%s')", lead_id, status_name, row_num, ws.title)
+    def _store_status_snapshot(self, gen: int, snap: Tuple) -> None:
+        """Keep ``snap`` unless the sheet was written since generation ``gen``."""
+        with self._snapshot_lock:
+            if self._snapshot_gen == gen:
+                self._status_snapshot = snap
+
+    def find_row(self, ws, lead_id: str) -> Optional[int]:
+        """O(1) row lookup via in-memory index (cold start: one ID-column read)."""
+        return self._get_row_index(ws, ws.title).get(_row_key(lead_id))
+
+    @_retry_sheets_api
+    def flush_batch(self, writes: List[Dict[str, Any]]) -> None:
+        """Apply a list of queued sheet writes with a minimum of API calls.
+
+        Each entry is either ``{"op": "upsert", "tab": ..., "row": [...]}`` or
+        ``{"op": "status", "tab": ..., "lead_id": ..., "status": ...}``; other
+        keys are ignored.  Upserts update the lead's row in place or append it;
+        status writes set only the Статус cell of an existing row.  The result
+        matches applying the entries one by one in list order, but costs one
+        append_rows per tab for new leads plus one values.batchUpdate for the
+        in-place writes.  Whole rows go in RAW and status cells USER_ENTERED,
+        so a run of mixed writes is split into one request per switch.
+        """
+        if not writes:
+            return
+        # Dropped again once the writes are done (or failed part-way), so a poll
+        # read that ran while they were in flight is never reused.
+        self._drop_status_snapshot()
+        try:
+            default_tab = datetime.now().strftime("%m.%Y")
+            sheets = {
+                tab: self._get_or_create_month_sheet(tab)
+                for tab in {w["tab"] or default_tab for w in writes}
+            }
+            with self.lock:
+                # Pass 1: decide per write whether it appends, updates in place, or misses.
+                new_rows: Dict[str, List[List[Any]]] = {}   # ws_name → rows to append
+                new_ids: Dict[str, List[str]] = {}          # ws_name → their lead ids
+                ws_by_name: Dict[str, Any] = {}
+                ops: List[Tuple[Any, str, Dict[str, Any]]] = []
+                for w in writes:
+                    ws = sheets[w["tab"] or default_tab]
+                    ws_by_name[ws.title] = ws
+                    is_upsert = w["op"] == "upsert"
+                    lead_id = str(w["row"][ID_COL_INDEX]) if is_upsert else str(w["lead_id"])
+                    key = _row_key(lead_id)
+                    if key is None:
+                        # Unindexable: two such rows would share one index slot.
+                        _log_lead.warning("SHEET WRITE — lead id '%s' is not numeric, skipped", lead_id)
+                        continue
+                    known = key in self._get_row_index(ws, ws.title) or lead_id in new_ids.get(ws.title, ())
+                    if known:
+                        ops.append((ws, lead_id, w))
+                    elif is_upsert:
+                        new_rows.setdefault(ws.title, []).append(w["row"])
+                        new_ids.setdefault(ws.title, []).append(lead_id)
+                    else:
+                        _log_lead.warning("SHEET STATUS — lead %s not found in tab '%s'", lead_id, w["tab"])
+
+                # New leads: one append per tab; the rows land consecutively.
+                for ws_name, rows in new_rows.items():
+                    ws = ws_by_name[ws_name]
+                    self._write_bucket.acquire()
+                    result = ws.append_rows(
+                        rows,
+                        value_input_option="USER_ENTERED",
+                        insert_data_option="INSERT_ROWS",
+                    )
+                    start_row: int = self._row_count.get(ws_name, 1) + 1  # safe fallback
+                    try:
+                        updated_range = result.get("updates", {}).get("updatedRange", "")
+                        m = _UPDATED_RANGE_START_ROW_RE.search(updated_range)
+                        if m:
+                            start_row = int(m.group(1))
+                    except Exception:
+                        pass  # Keep fallback value
+                    row_idx = self._row_index[ws_name]
+                    for offset, lead_id in enumerate(new_ids[ws_name]):
+                        row_idx[_row_key(lead_id)] = start_row + offset
+                        _log_lead.info("SHEET INSERT row=%d lead=%s tab='%s'", start_row + offset, lead_id, ws_name)
+                    last_row = start_row + len(rows) - 1
+                    self._row_count[ws_name] = last_row
+                    self._ensure_status_dropdown(ws, start_row, last_row)
+
+                # Pass 2: in-place writes go out in values.batchUpdate calls, in order.
+                # (valueInputOption, data) per call; a new call starts whenever the
+                # input option changes.
+                batches: List[Tuple[str, List[Dict[str, Any]]]] = []
+                for ws, lead_id, w in ops:
+                    row_num = self._row_index[ws.title][_row_key(lead_id)]
+                    if w["op"] == "upsert":
+                        option = "RAW"
+                        entry = {"range": absolute_range_name(ws.title, f"A{row_num}"), "values": [w["row"]]}
+                        _log_lead.info("SHEET UPDATE row=%d lead=%s tab='%s'", row_num, lead_id, ws.title)
+                    else:
+                        option = "USER_ENTERED"
+                        entry = {
+                            "range": absolute_range_name(ws.title, f"{STATUS_COL_LETTER}{row_num}"),
+                            "values": [[w["status"]]],
+                        }
+                        _log_lead.info(
+                            "SHEET STATUS lead=%s → '%s' (row=%d tab='%s')", lead_id, w["status"], row_num, ws.title,
+                        )
+                    if not batches or batches[-1][0] != option:
+                        batches.append((option, []))
+                    batches[-1][1].append(entry)
+                for option, data in batches:
+                    self._write_bucket.acquire()
+                    self.spreadsheet.values_batch_update(body={"valueInputOption": option, "data": data})
+        finally:
+            self._drop_status_snapshot()
 
     def iter_lead_statuses(self, tabs_filter: Optional[set] = None) -> List[Dict[str, str]]:
+        """Return lead statuses, reusing the last read for SHEET_SNAPSHOT_TTL_SEC.
+
+        A snapshot is only reused for the same ``tabs_filter`` and is dropped
+        whenever this process writes to the sheet, so webhook updates are never
+        echoed back from a stale read.
+
+        Once the TTL is up, the spreadsheet's Drive modifiedTime (one cheap
+        metadata call) is compared with the one recorded for the snapshot; if
+        nobody has edited the sheet since, the snapshot is kept for another TTL
+        instead of re-reading every tab.
+        """
+        key = frozenset(tabs_filter) if tabs_filter is not None else None
+        with self._snapshot_lock:
+            snap = self._status_snapshot
+            gen = self._snapshot_gen
+        now = time.monotonic()
+        if snap and snap[1] == key and now - snap[0] < self.cfg.SHEET_SNAPSHOT_TTL_SEC:
+            return snap[2]
+        modified = self._sheet_modified_time()
+        if snap and snap[1] == key and modified and snap[3] == modified:
+            self._store_status_snapshot(gen, (now, key, snap[2], modified))
+            return snap[2]
+        rows = self._read_lead_statuses(tabs_filter)
+        # A write during the read may not be in ``rows`` (nor in ``modified``),
+        # so the result is only kept if no write happened since ``gen``.
+        self._store_status_snapshot(gen, (now, key, rows, modified))
+        return rows
+
+    def _sheet_modified_time(self) -> Optional[str]:
+        """Drive modifiedTime of the spreadsheet, or None if it can't be fetched."""
+        try:
+            return self.spreadsheet.get_lastUpdateTime()
+        except Exception as exc:
+            _log.debug("Could not read spreadsheet modifiedTime: %s", exc)
+            return None
+
+    @_retry_sheets_api
+    def _batch_get_status_columns(self, tab_name: str) -> Dict[str, Any]:
+        """One batchGet of a tab's ID + Заказ № (B:C) and Воронка + Статус (T:U) ranges."""
+        return self.spreadsheet.values_batch_get(
+            [
+                absolute_range_name(tab_name, f"{ID_COL_LETTER}2:{ORDER_NUM_COL_LETTER}"),
+                absolute_range_name(tab_name, f"{PIPELINE_COL_LETTER}2:{STATUS_COL_LETTER}"),
+            ]
+        )
+
+    def _read_lead_statuses(self, tabs_filter: Optional[set] = None) -> List[Dict[str, str]]:
         """Iterate statuses across relevant monthly worksheets.
 
         When ``tabs_filter`` is provided only the named tabs are scanned,
@@ -1018,7 +1530,6 @@ class SheetSync:
         now = time.time()
         if not self._ws_titles_cache or now - self._ws_titles_ts > 120:
             try:
-                self.spreadsheet = self.gc.open_by_key(self.cfg.GOOGLE_SHEET_ID)
                 self._ws_titles_cache = [ws.title for ws in self.spreadsheet.worksheets()]
                 self._ws_titles_ts = now
             except Exception as exc:
@@ -1036,88 +1547,218 @@ class SheetSync:
 
         for tab_name in tabs_to_scan:
             try:
-                ws = self._get_or_create_month_sheet(tab_name)
-                # Read once — reuse the same get_all_values() result to both
-                # populate the output list AND refresh the in-memory row index so
-                # that subsequent update_status / find_row calls use correct row
-                # numbers even if the sheet was externally modified since last build.
-                all_vals = ws.get_all_values()
-                if not all_vals:
-                    continue
-                new_idx: Dict[str, int] = {}
-                last_data_row = 0
-                for i, row in enumerate(all_vals):
-                    if any(str(c).strip() for c in row):
-                        last_data_row = i + 1
-                    if i == 0:
-                        continue  # skip header row
-                    if len(row) <= max(ID_COL_INDEX, STATUS_COL_INDEX):
-                        continue
-                    lead_id = str(row[ID_COL_INDEX]).strip()
+                # Opens the tab once (checking its header row); the read below
+                # goes through values_batch_get and needs no worksheet handle.
+                self._get_or_create_month_sheet(tab_name)
+                # Read only the four columns we need (ID + Заказ № as one B:C range,
+                # Воронка + Статус as another) in a single batchGet — ~4/21 of the
+                # cells a get_all_values() would pull.  The same result also refreshes the
+                # in-memory row index so that subsequent flush_batch / find_row
+                # calls use correct row numbers even if the sheet was externally
+                # modified since last build.
+                resp = self._batch_get_status_columns(tab_name)
+                value_ranges = resp.get("valueRanges") or [{}, {}]
+                id_order_col = value_ranges[0].get("values") or []
+                pipeline_status_col = value_ranges[1].get("values") or []
+                new_idx: Dict[int, int] = {}
+                last_data_row = 1  # header row is always present
+                for i in range(max(len(id_order_col), len(pipeline_status_col))):
+                    row_num = i + 2  # data starts on sheet row 2
+                    id_order = id_order_col[i] if i < len(id_order_col) else []
+                    lead_id = str(id_order[0]).strip() if id_order else ""
+                    order_number = str(id_order[1]).strip() if len(id_order) > 1 else ""
+                    pipeline_status = pipeline_status_col[i] if i < len(pipeline_status_col) else []
+                    pipeline_display = str(pipeline_status[0]).strip() if pipeline_status else ""
+                    status = str(pipeline_status[1]).strip() if len(pipeline_status) > 1 else ""
+                    if lead_id or order_number or status:
+                        last_data_row = row_num
                     if not lead_id:
                         continue
-                    new_idx[lead_id] = i + 1  # 1-based sheet row number
-                    status = str(row[STATUS_COL_INDEX]).strip()
-                    order_number = str(row[ORDER_NUM_COL_INDEX]).strip() if len(row) > ORDER_NUM_COL_INDEX else ""
+                    if lead_id.isdigit():
+                        new_idx[int(lead_id)] = row_num  # 1-based sheet row number
                     out.append({
                         "lead_id": lead_id,
                         "status": status,
                         "order_number": order_number,
+                        "pipeline_display": pipeline_display,
                         "tab_name": tab_name,
                     })
                 # Atomically replace the cached row index with the fresh one.
-                # This prevents update_status from writing to wrong rows when
+                # This prevents flush_batch from writing to wrong rows when
                 # external scripts or users insert/delete rows between poll cycles.
                 self._row_index[tab_name] = new_idx
                 self._row_count[tab_name] = last_data_row
+            except gspread.exceptions.APIError as exc:
+                # Quota / server errors that outlived the per-call retries fail the
+                # whole read, so the poll loop backs off instead of acting on a
+                # partial sheet.
+                if _api_error_status(exc) in _RETRYABLE_STATUS:
+                    raise
+                _log.warning("iter_lead_statuses: could not read tab '%s': %s", tab_name, exc)
             except Exception as exc:
                 _log.warning("iter_lead_statuses: could not read tab '%s': %s", tab_name, exc)
         return out
 
 
 def parse_payload(raw: bytes, content_type: str) -> Dict[str, Any]:
-    text = raw.decode("utf-8") if raw else ""
     if "application/json" in (content_type or ""):
-        if not text:
-            return {}
-        return json.loads(text)
+        # json.loads decodes UTF-8 bytes itself; no separate str copy of the body.
+        return json.loads(raw) if raw else {}
 
+    text = raw.decode("utf-8") if raw else ""
     parsed = parse_qs(text, keep_blank_values=True)
     return {k: (v[0] if isinstance(v, list) and v else "") for k, v in parsed.items()}
 
 
+_LEADS_KEY_RE = re.compile(r"^leads\[(add|update|status)\]\[(\d+)\]\[(.+)\]$")
+
+
+@functools.lru_cache(maxsize=4096)
+def _lead_key_parts(key: str) -> Optional[Tuple[Tuple[str, str], str]]:
+    """((action, idx), field) for a ``leads[action][idx][field]`` form key, else None.
+
+    AMO sends the same few hundred keys in every webhook, so after warm-up each
+    key is a cache hit instead of a regex match.  The (action, idx) tuple is used
+    directly as the grouping key, so no per-field f-string is built; each form
+    key caches its own tuple, so fields of one lead get equal tuples, not one
+    shared object.
+    """
+    m = _LEADS_KEY_RE.match(key)
+    if m is None:
+        return None
+    action, idx, field = m.groups()
+    return (action, idx), field
+
+
+def _group_lead_fields(pairs) -> List[Dict[str, Any]]:
+    """Group flat ``leads[action][idx][field]`` form pairs into one dict per lead.
+
+    A repeated key keeps its first value, as parse_payload does.
+    """
+    grouped: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for key, value in pairs:
+        # Cheap prefix test first: account[...] etc. never reach the key cache.
+        if not key.startswith("leads["):
+            continue
+        parts = _lead_key_parts(key)
+        if parts is None:
+            continue
+        group, field = parts
+        grouped.setdefault(group, {}).setdefault(field, value)
+    return list(grouped.values())
+
+
 def extract_leads(data: Dict[str, Any]) -> List[Dict[str, Any]]:
     if isinstance(data.get("_embedded"), dict) and isinstance(data["_embedded"].get("leads"), list):
         return data["_embedded"]["leads"]
+    return _group_lead_fields(data.items())
 
-    grouped: Dict[str, Dict[str, Any]] = {}
-    pattern = re.compile(r"^leads\[(add|update|status)\]\[(\d+)\]\[(.+)\]$")
 
-    for key, value in data.items():
-        m = pattern.match(key)
-        if not m:
-            continue
-        action, idx, field = m.groups()
-        group_key = f"{action}_{idx}"
-        grouped.setdefault(group_key, {})[field] = value
+def parse_webhook_leads(raw: bytes, content_type: str) -> List[Dict[str, Any]]:
+    """parse_payload + extract_leads in one pass.
 
-    return list(grouped.values())
+    Form-encoded bodies (what AMO actually sends) are streamed through
+    parse_qsl straight into the per-lead groups, without building the
+    intermediate field dict.
+    """
+    if "application/json" in (content_type or ""):
+        return extract_leads(parse_payload(raw, content_type))
+    text = raw.decode("utf-8") if raw else ""
+    return _group_lead_fields(parse_qsl(text, keep_blank_values=True))
+
+
+@functools.lru_cache(maxsize=1024)
+def _norm_code(code: str) -> str:
+    """Strip leading zeros from a staff code ("0100" -> "100", "0005" -> "5").
+
+    Non-numeric codes are returned unchanged.
+    """
+    try:
+        return str(int(code))
+    except ValueError:
+        return code
+
+
+def _to_int(value: Any) -> int:
+    """Coerce an AMO id/timestamp to int; None, "" and 0 all become 0.
+
+    AMO's JSON API already sends ints (returned as-is), while form-encoded
+    webhooks deliver strings.
+    """
+    if isinstance(value, int):
+        return value
+    return int(value) if value else 0
+
+
+def _row_key(lead_id: Any) -> Optional[int]:
+    """SheetSync row-index key for a lead ID: the int AMO assigned, None if not numeric.
+
+    Row indexes are keyed by int — a small int is cheaper to store and hash than
+    the ID's string form, and the string API of find_row & co. stays unchanged.
+    Non-numeric IDs have no key and are never indexed (nor written by flush_batch).
+    """
+    text = str(lead_id).strip()
+    return int(text) if text.isdigit() else None
+
+
+# Webhook payload fields coerced to int once, on entry to process_webhook_leads.
+_WEBHOOK_INT_FIELDS = ("status_id", "pipeline_id", "responsible_user_id")
+
+
+# Contact custom fields (upper-cased name) that carry phone numbers.
+_PHONE_FIELD_NAMES = frozenset({"PHONE", "ТЕЛЕФОН"})
+
+
+@functools.lru_cache(maxsize=1024)
+def _norm_field_name(field_name: str) -> str:
+    """Collapse whitespace in an AMO field name (e.g. "Количество  1" -> "Количество 1").
+
+    AMO sends the same few dozen names on every lead, so the result is cached.
+    """
+    return " ".join(field_name.split())
+
+
+# Lead custom fields that carry a Unix timestamp, shown as a date in the sheet.
+_DATE_FIELDS = frozenset({"Дата заказа", "Дата доставка"})
+# Lead custom field holding the staff code looked up in staff_mapping.
+_STAFF_CODE_FIELD = "Код сотрудника"
+
+
+def _join_cf_values(values: List[Dict[str, Any]]) -> str:
+    """Join a custom field's values (e.g. multiple products) into one cell."""
+    return ", ".join(str(v.get("value", "")) for v in values if v.get("value") is not None)
+
+
+def _cf_date(values: List[Dict[str, Any]]) -> str:
+    """Cell text for a timestamp field: the first value as a date.
+
+    The raw joined value is kept when it is not a valid timestamp.
+    """
+    try:
+        first_val = values[0].get("value", "")
+        converted = _ts_to_date(first_val)
+        if converted or first_val in (0, "0", "", None):
+            return converted
+    except Exception:
+        pass
+    return _join_cf_values(values)
 
 
 def build_row(lead: Dict[str, Any], status_name: str, pipeline_name: str = "", responsible_name: str = "", staff_mapping: Dict[str, str] = None) -> List[Any]:
-    display_status = STATUS_DISPLAY_MAP.get(status_name, status_name)
+    display_status = _status_display_name(status_name) or status_name
     display_pipeline = PIPELINE_DISPLAY_MAP.get(pipeline_name, pipeline_name)
 
     # Extract contact name and ALL phone numbers from embedded contacts
     contact_name = lead.get("name", "")
     _phone_seen: list = []
-    contacts = (lead.get("_embedded") or {}).get("contacts") or []
+    embedded = lead.get("_embedded") or {}
+    contacts = embedded.get("contacts") or []
     for contact in contacts:
         if contact.get("name"):
             contact_name = contact["name"]
         # custom_fields_values may already be embedded (if fetched with full contact)
         for cf in contact.get("custom_fields_values") or []:
-            if cf.get("field_code") == "PHONE" or cf.get("field_name", "").upper() in ("PHONE", "ТЕЛЕФОН"):
+            if cf.get("field_code") == "PHONE" or cf.get("field_name", "").upper() in _PHONE_FIELD_NAMES:
                 for v in cf.get("values") or []:
                     num = str(v.get("value", "")).strip().lstrip("+")
                     if num and num not in _phone_seen:
@@ -1126,67 +1767,50 @@ def build_row(lead: Dict[str, Any], status_name: str, pipeline_name: str = "", r
 
     # Extract company name from embedded companies
     company_name = ""
-    companies = (lead.get("_embedded") or {}).get("companies") or []
+    companies = embedded.get("companies") or []
     if companies:
         company_name = companies[0].get("name", "")
 
-    mapped: Dict[str, Any] = {
-        "ID": lead.get("id", ""),
-        "Бюджет сделки": lead.get("price", ""),
-        "Статус": display_status,
-        "Воронка": display_pipeline,
-        "Ф.И.О.": contact_name,
-        "Контактный номер": contact_phone,
-        "Компания": company_name,
-        "Ответственный": responsible_name,
-    }
+    row: List[Any] = [""] * len(COLUMNS)
+    row[ID_COL_INDEX] = lead.get("id", "")
+    row[_BUDGET_COL_INDEX] = lead.get("price", "")
+    row[_CONTACT_NAME_COL_INDEX] = contact_name
+    row[_CONTACT_PHONE_COL_INDEX] = contact_phone
+    row[_COMPANY_COL_INDEX] = company_name
+    row[_RESPONSIBLE_COL_INDEX] = responsible_name
 
     if isinstance(lead.get("custom_fields_values"), list):
         for cf in lead["custom_fields_values"]:
-            field_name = cf.get("field_name", "")
-            # Normalize spaces (e.g. "Количество  1" -> "Количество 1")
-            norm_name = " ".join(field_name.split())
-            values = cf.get("values") or []
-            if norm_name in COLUMNS and values:
-                # Join multiple values if present (e.g. multiple products)
-                val = ", ".join(str(v.get("value", "")) for v in values if v.get("value") is not None)
-                
+            values = cf.get("values")
+            if not values:
+                continue
+            norm_name = _norm_field_name(cf.get("field_name") or "")
+            col_idx = _COLUMN_INDEX.get(norm_name)
+            if col_idx is None:
+                continue
+            if norm_name in _DATE_FIELDS:
                 # Convert Unix timestamps to human-readable dates
-                if norm_name in ("Дата заказа", "Дата доставка"):
-                    try:
-                        first_val = values[0].get("value", "")
-                        converted = _ts_to_date(first_val)
-                        # Only replace val if conversion succeeded; otherwise keep raw
-                        if converted or first_val in (0, "0", "", None):
-                            val = converted
-                    except Exception:
-                        pass  # Keep original value if conversion fails
-                        
-                mapped[norm_name] = val
-                
-                if norm_name == "Код сотрудника" and staff_mapping:
-                    clean_val = val.strip()
-                    # Remove leading zeros to match the Staff sheet (e.g., "0100" -> "100", "0005" -> "5")
-                    try:
-                        clean_val = str(int(clean_val))
-                    except ValueError:
-                        pass
-                        
-                    if clean_val in staff_mapping:
-                        mapped["Ответственный"] = staff_mapping[clean_val]
+                row[col_idx] = _cf_date(values)
+                continue
+            val = _join_cf_values(values)
+            row[col_idx] = val
+            if norm_name == _STAFF_CODE_FIELD and staff_mapping:
+                clean_val = _norm_code(val.strip())
+                if clean_val in staff_mapping:
+                    row[_RESPONSIBLE_COL_INDEX] = staff_mapping[clean_val]
 
     # If "Дата заказа" was not filled in AmoCRM, fall back to the lead's own
     # created_at timestamp (the moment the lead was created in AMO).
     # This is shown with time since it is a precise creation moment.
-    if not mapped.get("Дата заказа"):
-        mapped["Дата заказа"] = _ts_to_date(lead.get("created_at"), include_time=True)
+    if not row[_ORDER_DATE_COL_INDEX]:
+        row[_ORDER_DATE_COL_INDEX] = _ts_to_date(lead.get("created_at"), include_time=True)
 
     # Re-apply pipeline-derived fields AFTER custom fields so AMO custom fields
     # named "Статус" or "Воронка" can never silently overwrite the correct values.
-    mapped["Статус"] = display_status
-    mapped["Воронка"] = display_pipeline
+    row[STATUS_COL_INDEX] = display_status
+    row[PIPELINE_COL_INDEX] = display_pipeline
 
-    return [mapped.get(col, "") for col in COLUMNS]
+    return row
 
 
 class SyncService:
@@ -1197,18 +1821,47 @@ class SyncService:
         self.amo = AmoClient(self.cfg, self.token_store)
         self.sheet = SheetSync(self.cfg)
         self.state_lock = threading.Lock()
+        # Orders whole saves (snapshot + disk write); state_lock covers only the snapshot.
+        self._state_write_lock = threading.Lock()
         self.state_path = Path(".sync_state.json")
+        # Large states are stored gzipped next to it (see _save_state).
+        self.state_gz_path = self.state_path.with_name(self.state_path.name + ".gz")
         self.state = self._load_state()
+        # Per-lead maps inside self.state, bound once so remember_*/get_* skip the
+        # outer lookup.  They are only ever mutated in place, never replaced.
+        # Keys are str lead IDs; every caller already holds the ID as a str.
+        self._status_by_lead: Dict[str, str] = self.state.setdefault("sheet_status_by_lead", {})
+        self._order_by_lead: Dict[str, str] = self.state.setdefault("sheet_order_number_by_lead", {})
+        self._expiry_by_lead: Dict[str, float] = self.state.setdefault("lead_expiry", {})
+        self._tab_by_lead: Dict[str, str] = self.state.setdefault("lead_tab_by_lead", {})
+        self._pipeline_by_lead: Dict[str, int] = self.state.setdefault("lead_pipeline_by_lead", {})
         self._state_dirty: bool = False  # True when in-memory state differs from disk
-        self.trigger_status_ids: set[int] = set()
-        self.terminal_status_id_to_name: Dict[str, str] = {}
-        self.pipeline_status_name_to_id: Dict[int, Dict[str, int]] = {}
-        self.pipeline_status_display_to_id: Dict[int, Dict[str, int]] = {}
+        # Mutations only mark state dirty; a background flusher persists it every
+        # _STATE_FLUSH_INTERVAL_SEC (sooner when request_state_flush() is called),
+        # and atexit catches whatever is left on shutdown.
+        self._state_flush_event = threading.Event()
+        threading.Thread(target=self._state_flush_loop, daemon=True, name="state-flusher").start()
+        atexit.register(self.flush_state)
+        # Both are filled once by _load_structure_mappings and read-only afterwards.
+        self.trigger_status_ids: frozenset = frozenset()
+        self.terminal_status_id_to_name: Dict[int, str] = {}
+        # Flat (pipeline_id, status name) → status_id table.  Holds both the raw AMO
+        # name and the display name of every status; display names win on collision.
+        self._status_lookup: Dict[Tuple[int, str], int] = {}
         self.pipeline_id_to_name: Dict[int, str] = {}
+        # Sheet "Воронка" value → pipeline_id; display names shared by several
+        # pipelines are left out since they can't identify one.
+        self.pipeline_display_to_id: Dict[str, int] = {}
+        # pipeline_ids whose name contains PIPELINE_KEYWORD (see _pipeline_in_scope).
+        self.keyword_pipeline_ids: frozenset = frozenset()
         self.status_id_to_display_name: Dict[int, str] = {}
+        # status_id → value a webhook writes to the sheet (display name with
+        # AMO_STATUS_TO_SHEET_OVERRIDE already applied; terminal names win).
+        self.status_id_to_sheet_status: Dict[int, str] = {}
         self.users_map: Dict[int, str] = {}
-        # Deduplication cache: maps "lead_id:status_id" -> timestamp of last processing
-        self._webhook_dedup: Dict[str, float] = {}
+        # Deduplication cache: (lead_id, status_id) -> monotonic time of last processing,
+        # kept in processing order so expired entries are always at the front.
+        self._webhook_dedup: "OrderedDict[Tuple[str, int], float]" = OrderedDict()
         self._dedup_lock = threading.Lock()
         self._load_structure_mappings()
         self._load_users()
@@ -1222,23 +1875,29 @@ class SyncService:
         )
         _log.info("KPI store initialised at %s", _kpi_db)
 
+    _WEBHOOK_DEDUP_MAX = 10_000
+
     def _is_duplicate_webhook(self, lead_id: str, status_id: int) -> bool:
         """Return True if this (lead_id, status_id) was already processed within WEBHOOK_DEDUP_TTL_SEC.
-        Also evicts stale entries to prevent unbounded memory growth.
+        Expired entries are evicted from the front of the cache, and it never holds
+        more than _WEBHOOK_DEDUP_MAX keys, so a retry storm costs O(1) per event.
         """
-        key = f"{lead_id}:{status_id}"
-        now = time.time()
+        key = (lead_id, status_id)
+        now = time.monotonic()
         ttl = self.cfg.WEBHOOK_DEDUP_TTL_SEC
+        cache = self._webhook_dedup
         with self._dedup_lock:
-            # Evict entries older than 2x TTL
-            stale = [k for k, ts in self._webhook_dedup.items() if now - ts > ttl * 2]
-            for k in stale:
-                del self._webhook_dedup[k]
-            if key in self._webhook_dedup and now - self._webhook_dedup[key] < ttl:
+            while cache and (len(cache) >= self._WEBHOOK_DEDUP_MAX or now - next(iter(cache.values())) >= ttl):
+                cache.popitem(last=False)
+            if key in cache:
                 return True
-            self._webhook_dedup[key] = now
+            cache[key] = now
             return False
 
+    def _pipeline_in_scope(self, pipeline_id: int) -> bool:
+        """False if PIPELINE_KEYWORD is set and this pipeline's name doesn't contain it."""
+        return not self.cfg.PIPELINE_KEYWORD or pipeline_id in self.keyword_pipeline_ids
+
     def _load_users(self) -> None:
         try:
             data = self.amo.get("/api/v4/users?limit=250")
@@ -1260,8 +1919,16 @@ class SyncService:
                     _log.info("Open auth URL: %s", self.amo.auth_url())
             pipelines = []
 
+        trigger_ids: set[int] = set()
+        # Every configured trigger name (primary + extras), raw and as displayed.
+        trigger_raw = {self.cfg.TRIGGER_STATUS_NAME} | {
+            t.strip() for t in self.cfg.TRIGGER_STATUS_NAMES_EXTRA.split(",") if t.strip()
+        }
+        trigger_display = {_status_display_name(t) or t for t in trigger_raw}
+        by_raw_name: Dict[Tuple[int, str], int] = {}
+        by_display_name: Dict[Tuple[int, str], int] = {}
         for pipeline in pipelines:
-            pipeline_id = int(pipeline.get("id", 0) or 0)
+            pipeline_id = _to_int(pipeline.get("id"))
             pipeline_raw_name = str(pipeline.get("name", "")).strip()
             self.pipeline_id_to_name[pipeline_id] = pipeline_raw_name
 
@@ -1276,52 +1943,69 @@ class SyncService:
                 )
 
             statuses = pipeline.get("_embedded", {}).get("statuses", [])
-            if pipeline_id not in self.pipeline_status_name_to_id:
-                self.pipeline_status_name_to_id[pipeline_id] = {}
-            if pipeline_id not in self.pipeline_status_display_to_id:
-                self.pipeline_status_display_to_id[pipeline_id] = {}
 
             for status in statuses:
                 status_name = str(status.get("name", "")).strip()
-                status_id = int(status.get("id", 0) or 0)
+                status_id = _to_int(status.get("id"))
                 if not status_id or not status_name:
                     continue
 
                 # Prefer exact match; fall back to normalized (handles mixed
                 # Latin/Cyrillic chars and casing variants like Rushana's pipeline).
-                display_name = (
-                    STATUS_DISPLAY_MAP.get(status_name)
-                    or _STATUS_DISPLAY_NORMALIZED.get(_normalize_amo_name(status_name))
-                    or _STATUS_DISPLAY_LOWERED.get(status_name.lower())
-                    or status_name
-                )
-                self.pipeline_status_name_to_id[pipeline_id][status_name] = status_id
-                self.pipeline_status_display_to_id[pipeline_id][display_name] = status_id
+                display_name = _status_display_name(status_name) or status_name
+                by_raw_name[(pipeline_id, status_name)] = status_id
+                by_display_name[(pipeline_id, display_name)] = status_id
                 self.status_id_to_display_name[status_id] = display_name
 
-                # Build the full list of trigger names to check (primary + extras).
-                all_trigger_names = [self.cfg.TRIGGER_STATUS_NAME]
-                for _tn in self.cfg.TRIGGER_STATUS_NAMES_EXTRA.split(","):
-                    _tn = _tn.strip()
-                    if _tn and _tn not in all_trigger_names:
-                        all_trigger_names.append(_tn)
-
                 # Match trigger by raw name OR display name across ALL configured trigger names.
-                for t_name in all_trigger_names:
-                    t_display = STATUS_DISPLAY_MAP.get(t_name, t_name)
-                    if status_name == t_name or display_name == t_display:
-                        self.trigger_status_ids.add(status_id)
-                        break
+                if status_name in trigger_raw or display_name in trigger_display:
+                    trigger_ids.add(status_id)
 
                 if display_name in self.cfg.STATUS_MAP or status_name in self.cfg.STATUS_MAP:
-                    self.terminal_status_id_to_name[str(status_id)] = display_name
+                    self.terminal_status_id_to_name[status_id] = display_name
+
+        # Pipeline 0 holds the .env DROPDOWN_STATUS_MAP_JSON IDs as a pipeline-agnostic
+        # fallback, so resolve_status_id needs no second lookup path.
+        for name, sid in self.cfg.STATUS_MAP.items():
+            if sid:
+                self._status_lookup[(0, name)] = int(sid)
+        self._status_lookup.update(by_raw_name)
+        self._status_lookup.update(by_display_name)
+
+        display_ids: Dict[str, set] = {}
+        for pid, pname in self.pipeline_id_to_name.items():
+            display_ids.setdefault(PIPELINE_DISPLAY_MAP.get(pname, pname), set()).add(pid)
+        self.pipeline_display_to_id = {
+            name: next(iter(ids)) for name, ids in display_ids.items() if name and len(ids) == 1
+        }
+        keyword = self.cfg.PIPELINE_KEYWORD
+        self.keyword_pipeline_ids = frozenset(
+            pid for pid, pname in self.pipeline_id_to_name.items() if keyword and keyword in pname.lower()
+        )
 
         if self.cfg.TRIGGER_STATUS_ID:
-            self.trigger_status_ids.add(self.cfg.TRIGGER_STATUS_ID)
+            trigger_ids.add(self.cfg.TRIGGER_STATUS_ID)
+        self.trigger_status_ids = frozenset(trigger_ids)
 
         if not self.terminal_status_id_to_name:
             self.terminal_status_id_to_name = dict(self.cfg.STATUS_ID_TO_NAME)
 
+        override = AMO_STATUS_TO_SHEET_OVERRIDE
+        sheet_status = {
+            sid: override.get(name, name) for sid, name in self.status_id_to_display_name.items()
+        }
+        for sid, name in self.terminal_status_id_to_name.items():
+            sheet_status[sid] = override.get(name, name)
+        self.status_id_to_sheet_status = sheet_status
+
+    def resolve_status_id(self, pipeline_id: int, name: str) -> int:
+        """Return the status ID for a display (or raw AMO) status name in a pipeline.
+
+        Falls back to the pipeline-agnostic DROPDOWN_STATUS_MAP_JSON entry, 0 if unknown.
+        """
+        lookup = self._status_lookup
+        return lookup.get((pipeline_id, name)) or lookup.get((0, name), 0)
+
     def _print_config_warnings(self) -> None:
         if not self.trigger_status_ids:
             _log.warning("No trigger status IDs resolved. Leads will NOT be added from webhook.")
@@ -1333,45 +2017,130 @@ class SyncService:
         _log.info("Resolved trigger status IDs: %s", sorted(self.trigger_status_ids))
 
     def _load_state(self) -> Dict[str, Dict[str, str]]:
-        if self.state_path.exists():
-            return json.loads(self.state_path.read_text(encoding="utf-8"))
-        return {"sheet_status_by_lead": {}}
+        # Normally only one of the two files exists; if a crash left both behind,
+        # the newer one is the last completed save.
+        existing = [p for p in (self.state_path, self.state_gz_path) if p.exists()]
+        if not existing:
+            return {"sheet_status_by_lead": {}}
+        path = max(existing, key=lambda p: p.stat().st_mtime_ns)
+        raw = path.read_bytes()
+        if path == self.state_gz_path:
+            raw = gzip.decompress(raw)
+        return json.loads(raw)
 
     def _save_state(self) -> None:
-        """Unconditionally write state to disk. Prefer flush_state() for batching."""
-        with self.state_lock:
-            self.state_path.write_text(
-                json.dumps(self.state, ensure_ascii=False, indent=2),
-                encoding="utf-8",
-            )
-            self._state_dirty = False
+        """Unconditionally write state to disk. Prefer flush_state() for batching.
+
+        Writes to a temp file and os.replace()s it over the real one, so a crash
+        mid-write can never leave a truncated .sync_state.json behind.  The file
+        is written compact: it holds up to STATE_MAX_TRACKED_LEADS entries per map
+        and is serialised under state_lock, so indentation is pure overhead.
+
+        Once more than _STATE_GZIP_MIN_LEADS leads are tracked it is written to
+        .sync_state.json.gz instead (compresslevel=1: several times smaller for
+        little CPU), and the file in the other format is removed.
+
+        Only serialisation holds state_lock; the disk write happens after it is
+        released, so remember_* calls are not blocked on file I/O.
+        _state_write_lock keeps concurrent saves from landing out of order.
+        """
+        with self._state_write_lock:
+            with self.state_lock:
+                payload = json.dumps(self.state, ensure_ascii=False, separators=(",", ":"))
+                compress = len(self._status_by_lead) > self._STATE_GZIP_MIN_LEADS
+                self._state_dirty = False
+            try:
+                if compress:
+                    _atomic_write_bytes(
+                        self.state_gz_path, gzip.compress(payload.encode("utf-8"), compresslevel=1)
+                    )
+                    self.state_path.unlink(missing_ok=True)
+                else:
+                    _atomic_write_text(self.state_path, payload)
+                    self.state_gz_path.unlink(missing_ok=True)
+            except Exception:
+                # The snapshot never reached disk: mark state dirty again so the
+                # next flush retries instead of waiting for an unrelated change.
+                with self.state_lock:
+                    self._state_dirty = True
+                raise
 
     def flush_state(self) -> None:
         """Write state to disk only if it changed since the last save (batching)."""
         if self._state_dirty:
+            self._trim_state()
             self._save_state()
 
+    _STATE_FLUSH_INTERVAL_SEC = 2.0
+    # After a wake-up the flusher waits this long so back-to-back batches share one write.
+    _STATE_FLUSH_COALESCE_SEC = 0.25
+    # Tracked-lead count above which the state file is stored gzipped.
+    _STATE_GZIP_MIN_LEADS = 5000
+
+    def request_state_flush(self) -> None:
+        """Ask the background flusher to persist state soon, without blocking the caller."""
+        self._state_flush_event.set()
+
+    def _state_flush_loop(self) -> None:
+        """Background thread: persist dirty state every _STATE_FLUSH_INTERVAL_SEC,
+        or shortly after request_state_flush()."""
+        while True:
+            if self._state_flush_event.wait(self._STATE_FLUSH_INTERVAL_SEC):
+                time.sleep(self._STATE_FLUSH_COALESCE_SEC)
+            self._state_flush_event.clear()
+            try:
+                self.flush_state()
+            except Exception as exc:
+                _log.error("Background state flush failed: %s", exc)
+
+    def _trim_state(self) -> None:
+        """Forget the oldest finished leads once STATE_MAX_TRACKED_LEADS is exceeded.
+
+        Only leads sync_sheet_to_amo no longer scans are eligible — a finished
+        status on a tab outside _active_tabs().  Dropping a live lead would make
+        the next poll see an "unknown" status and re-push it to AMO.
+        """
+        cap = self.cfg.STATE_MAX_TRACKED_LEADS
+        statuses = self._status_by_lead
+        excess = len(statuses) - cap
+        if cap <= 0 or excess <= 0:
+            return
+        active_tabs = self._active_tabs()
+        lead_tabs = self._tab_by_lead
+        victims: List[str] = []
+        with self.state_lock:
+            # Dicts keep insertion order, so the first entries are the oldest leads.
+            for lid, status in statuses.items():
+                if status in self._FINISHED_SHEET_STATUSES and lead_tabs.get(lid) not in active_tabs:
+                    victims.append(lid)
+                    if len(victims) >= excess:
+                        break
+        for lid in victims:
+            self.forget_lead(lid)
+        if victims:
+            _log.info("State cap %d reached — forgot %d finished lead(s).", cap, len(victims))
+
     def remember_sheet_status(self, lead_id: str, status_name: str) -> None:
         with self.state_lock:
-            prev = self.state.get("sheet_status_by_lead", {}).get(str(lead_id), "")
-            self.state.setdefault("sheet_status_by_lead", {})[str(lead_id)] = status_name
+            prev = self._status_by_lead.get(lead_id, "")
+            self._status_by_lead[lead_id] = status_name
             self._state_dirty = True
         if prev != status_name:
             _log_lead.info("LEAD %s status tracked: '%s' → '%s'", lead_id, prev or "(new)", status_name)
 
     def get_known_sheet_status(self, lead_id: str) -> str:
-        return self.state.get("sheet_status_by_lead", {}).get(str(lead_id), "")
+        return self._status_by_lead.get(lead_id, "")
 
     def remember_sheet_order_number(self, lead_id: str, order_number: str) -> None:
         with self.state_lock:
-            prev = self.state.get("sheet_order_number_by_lead", {}).get(str(lead_id))
-            self.state.setdefault("sheet_order_number_by_lead", {})[str(lead_id)] = order_number
+            prev = self._order_by_lead.get(lead_id)
+            self._order_by_lead[lead_id] = order_number
             self._state_dirty = True
         if prev is not None and prev != order_number and order_number:
             _log_lead.info("LEAD %s order# tracked: '%s' → '%s'", lead_id, prev, order_number)
 
     def get_known_order_number(self, lead_id: str) -> str:
-        return self.state.get("sheet_order_number_by_lead", {}).get(str(lead_id), "")
+        return self._order_by_lead.get(lead_id, "")
 
     # ── Lead lifetime / expiry ────────────────────────────────────────────────
     # When a lead reaches a terminal status we start a countdown. Once the
@@ -1382,22 +2151,23 @@ class SyncService:
     def remember_lead_expiry(self, lead_id: str, expiry_ts: float) -> None:
         """Record the Unix timestamp at which we should stop tracking this lead."""
         with self.state_lock:
-            self.state.setdefault("lead_expiry", {})[str(lead_id)] = expiry_ts
+            self._expiry_by_lead[lead_id] = expiry_ts
             self._state_dirty = True
 
     def is_lead_expired(self, lead_id: str) -> bool:
         """Return True if the lead's monitoring window has already passed."""
-        expiry = self.state.get("lead_expiry", {}).get(str(lead_id))
+        expiry = self._expiry_by_lead.get(lead_id)
         return expiry is not None and time.time() >= expiry
 
     def forget_lead(self, lead_id: str) -> None:
         """Remove all tracking data for a lead (called when its lifetime ends)."""
         lid = str(lead_id)
         with self.state_lock:
-            prev_status = self.state.get("sheet_status_by_lead", {}).pop(lid, None)
-            self.state.get("sheet_order_number_by_lead", {}).pop(lid, None)
-            self.state.get("lead_expiry",                {}).pop(lid, None)
-            self.state.get("lead_tab_by_lead",           {}).pop(lid, None)
+            prev_status = self._status_by_lead.pop(lid, None)
+            self._order_by_lead.pop(lid, None)
+            self._expiry_by_lead.pop(lid, None)
+            self._tab_by_lead.pop(lid, None)
+            self._pipeline_by_lead.pop(lid, None)
             self._state_dirty = True
         _log_lead.info("LEAD %s forgotten (last status='%s')", lead_id, prev_status or "?")
 
@@ -1405,14 +2175,14 @@ class SyncService:
         """Purge leads whose monitoring window has elapsed. Called from the worker loop."""
         now = time.time()
         expired = [
-            lid for lid, ts in list(self.state.get("lead_expiry", {}).items())
+            lid for lid, ts in list(self._expiry_by_lead.items())
             if now >= ts
         ]
         for lid in expired:
             _log_lead.info("LEAD %s monitoring window expired — removing from tracking.", lid)
             self.forget_lead(lid)
         if expired:
-            self.flush_state()
+            self.request_state_flush()
 
     def _set_expiry_for_status(self, lead_id: str, status_display: str) -> None:
         """If status_display has a configured lifetime, start (or overwrite) the countdown."""
@@ -1439,7 +2209,7 @@ class SyncService:
     def remember_lead_tab(self, lead_id: str, tab_name: str) -> None:
         """Store which monthly sheet tab this lead was written to."""
         with self.state_lock:
-            self.state.setdefault("lead_tab_by_lead", {})[str(lead_id)] = tab_name
+            self._tab_by_lead[lead_id] = tab_name
             self._state_dirty = True
 
     def get_lead_tab(self, lead_id: str) -> str:
@@ -1449,7 +2219,7 @@ class SyncService:
         active sheet, which is always correct for leads written during the current
         month before a rotation occurred.
         """
-        tab = self.state.get("lead_tab_by_lead", {}).get(str(lead_id), "")
+        tab = self._tab_by_lead.get(lead_id, "")
         return tab if tab else self.cfg.GOOGLE_WORKSHEET_NAME
 
     def remember_lead_pipeline(self, lead_id: str, pipeline_id: int) -> None:
@@ -1457,12 +2227,31 @@ class SyncService:
         if not pipeline_id:
             return
         with self.state_lock:
-            self.state.setdefault("lead_pipeline_by_lead", {})[str(lead_id)] = pipeline_id
+            self._pipeline_by_lead[lead_id] = pipeline_id
             self._state_dirty = True
 
     def get_lead_pipeline(self, lead_id: str) -> int:
         """Return cached pipeline_id or 0 if not yet stored."""
-        return int(self.state.get("lead_pipeline_by_lead", {}).get(str(lead_id), 0) or 0)
+        return _to_int(self._pipeline_by_lead.get(lead_id))
+
+    def _remember_sheet_writes(self, writes: List[Dict[str, Any]]) -> None:
+        """Record in state what a successful flush_batch(writes) put on the sheet.
+
+        Only called once the write went through: if state ran ahead of the sheet,
+        the next poll would push the old sheet status back to AMO, and appended
+        rows that never landed would be forgotten as deleted.
+        """
+        for w in writes:
+            lead_id = w["lead_id"]
+            if _row_key(lead_id) is None:
+                continue  # flush_batch skipped it
+            self.remember_sheet_status(lead_id, w["status"])
+            self.remember_lead_pipeline(lead_id, w["pipeline_id"])
+            if w["op"] == "upsert":
+                self.remember_lead_tab(lead_id, w["tab"])
+                self.remember_sheet_order_number(lead_id, w["order_number"])
+            else:
+                self._set_expiry_for_status(lead_id, w["status"])
 
     # Set of display names considered valid for sheet status cells.
     _VALID_DISPLAY_STATUSES: frozenset = frozenset(STATUS_DISPLAY_MAP.values()) | frozenset(
@@ -1471,7 +2260,10 @@ class SyncService:
     )
 
     def bootstrap_sheet_state(self) -> None:
+        # The read below also rebuilds SheetSync's lead_id → row index, so the
+        # heal writes need no lookups and go out together in one flush_batch().
         rows = self.sheet.iter_lead_statuses()
+        heal_writes: List[Dict[str, Any]] = []
         for item in rows:
             raw_status = item["status"]
             lead_id    = item["lead_id"]
@@ -1483,31 +2275,31 @@ class SyncService:
             # by looking it up through the same normalised map used at runtime.
             healed_status = raw_status
             if raw_status and raw_status not in self._VALID_DISPLAY_STATUSES:
-                normalized = _normalize_amo_name(raw_status)
-                candidate = (
-                    STATUS_DISPLAY_MAP.get(raw_status)
-                    or _STATUS_DISPLAY_NORMALIZED.get(normalized)
-                    or _STATUS_DISPLAY_LOWERED.get(raw_status.lower())
-                )
+                candidate = _status_display_name(raw_status)
                 if candidate and candidate != raw_status:
                     _log_lead.warning(
                         "BOOTSTRAP heal: lead=%s tab='%s' cell status '%s' → corrected to '%s'",
                         lead_id, tab, raw_status, candidate,
                     )
-                    try:
-                        self.sheet.update_status(lead_id, candidate, tab)
-                    except Exception as exc:
-                        _log.warning("BOOTSTRAP heal failed for lead %s: %s", lead_id, exc)
+                    heal_writes.append({"op": "status", "tab": tab, "lead_id": lead_id, "status": candidate})
                     healed_status = candidate
 
             self.remember_sheet_status(lead_id, healed_status)
             # Snapshot the current order number so we can detect when it gets filled
             self.remember_sheet_order_number(lead_id, item.get("order_number", ""))
-            # Record which tab each lead lives on (used by update_status routing)
+            # Record which tab each lead lives on (used by status-write routing)
             if tab:
                 self.remember_lead_tab(lead_id, tab)
+        if heal_writes:
+            try:
+                self.sheet.flush_batch(heal_writes)
+            except Exception as exc:
+                _log.warning("BOOTSTRAP heal failed for %d lead(s): %s", len(heal_writes), exc)
         self.flush_state()  # Persist bootstrapped state in one write
 
+    # Queued initial-sync rows per flush_batch() call (bounds request size).
+    _INITIAL_SYNC_FLUSH_ROWS = 500
+
     def initial_sync_leads(self, date_from: str, date_to: str) -> None:
         """Fetch all AMO leads created in [date_from, date_to] and upsert them into the sheet.
 
@@ -1515,37 +2307,43 @@ class SyncService:
         Leads already present in the sheet are updated in-place; new ones are appended.
         """
         _log.info("Initial sync: fetching AMO leads created %s – %s …", date_from, date_to)
-        try:
-            leads = self.amo.fetch_leads_by_date_range(date_from, date_to)
-        except Exception as exc:
-            _log.error("Initial sync failed to fetch leads: %s", exc)
-            return
-
-        _log.info("Initial sync: %d lead(s) returned from AMO.", len(leads))
         staff_mapping = self.sheet.get_staff_mapping()
+        fetched = 0
         written = 0
         skipped = 0
 
-        for lead in leads:
+        def _leads() -> Iterator[Dict[str, Any]]:
+            # Leads arrive page by page, so only one page (plus the prefetched ones)
+            # is held at a time.  A fetch error ends the sync early; rows built so
+            # far are still flushed below.
+            nonlocal fetched
+            try:
+                for page in self.amo.iter_lead_pages_by_date_range(date_from, date_to):
+                    fetched += len(page)
+                    # Enrich with full contact details (phone numbers) in batched
+                    # requests rather than one GET per contact.
+                    self._batch_enrich_contacts(page)
+                    yield from page
+            except Exception as exc:
+                _log.error("Initial sync failed to fetch leads: %s", exc)
+
+        # Rows are queued and written in chunks by flush_batch(): one append per
+        # tab plus one values.batchUpdate per chunk instead of a call per lead.
+        sheet_writes: List[Dict[str, Any]] = []
+
+        for lead in _leads():
             lead_id = str(lead.get("id", "")).strip()
             if not lead_id:
                 skipped += 1
                 continue
 
-            # Enrich with full contact details (phone numbers).
-            try:
-                lead = self._enrich_lead_contacts(lead)
-            except Exception:
-                pass
-
-            status_id     = int(lead.get("status_id", 0) or 0)
-            pipeline_id   = int(lead.get("pipeline_id", 0) or 0)
-            pipeline_name = self.pipeline_id_to_name.get(pipeline_id, "")
+            status_id     = _to_int(lead.get("status_id"))
+            pipeline_id   = _to_int(lead.get("pipeline_id"))
             # Skip pipelines not matching the keyword filter (e.g. only "sotuv" pipelines).
-            if self.cfg.PIPELINE_KEYWORD and self.cfg.PIPELINE_KEYWORD not in pipeline_name.lower():
+            if not self._pipeline_in_scope(pipeline_id):
                 skipped += 1
                 continue
-            pipeline_display = PIPELINE_DISPLAY_MAP.get(pipeline_name, pipeline_name)
+            pipeline_name = self.pipeline_id_to_name.get(pipeline_id, "")
 
             # Resolve status display name via the same map used by webhooks.
             status_display = self.status_id_to_display_name.get(
@@ -1553,20 +2351,28 @@ class SyncService:
                 STATUS_DISPLAY_MAP.get(str(status_id), str(status_id)),
             )
 
-            responsible_id   = int(lead.get("responsible_user_id", 0) or 0)
+            responsible_id   = _to_int(lead.get("responsible_user_id"))
             responsible_name = self.users_map.get(responsible_id, str(responsible_id))
 
             tab_name = self._tab_for_lead(lead)
             row = build_row(lead, status_display, pipeline_name, responsible_name, staff_mapping)
-            self.sheet.upsert_row(row, tab_name)
-            self.remember_sheet_status(lead_id, status_display)
-            self.remember_lead_tab(lead_id, tab_name)
-            self.remember_lead_pipeline(lead_id, pipeline_id)
-            self.remember_sheet_order_number(lead_id, "")
+            sheet_writes.append({
+                "op": "upsert", "tab": tab_name, "row": row, "lead_id": lead_id,
+                "status": status_display, "pipeline_id": pipeline_id, "order_number": "",
+            })
             written += 1
+            if len(sheet_writes) >= self._INITIAL_SYNC_FLUSH_ROWS:
+                self.sheet.flush_batch(sheet_writes)
+                self._remember_sheet_writes(sheet_writes)
+                sheet_writes = []
 
+        self.sheet.flush_batch(sheet_writes)
+        self._remember_sheet_writes(sheet_writes)
         self.flush_state()  # Persist all initial sync state in one write
-        _log.info("Initial sync complete: %d written, %d skipped.", written, skipped)
+        _log.info(
+            "Initial sync complete: %d lead(s) from AMO, %d written, %d skipped.",
+            fetched, written, skipped,
+        )
 
     def check_and_rotate_sheet(self) -> None:
         """Archive the active worksheet when the month rolls over.
@@ -1625,7 +2431,7 @@ class SyncService:
         # Update lead_tab_by_lead: every lead that was on "Sheet1" is now on the
         # archive tab so status updates keep routing to the correct sheet.
         with self.state_lock:
-            lead_tabs = self.state.get("lead_tab_by_lead", {})
+            lead_tabs = self._tab_by_lead
             updated = 0
             for lid, tab in lead_tabs.items():
                 if tab == main_name:
@@ -1641,89 +2447,83 @@ class SyncService:
             self.state["active_sheet_month"] = current_month
         self._save_state()
 
-    def _enrich_lead_contacts(self, lead: Dict[str, Any]) -> Dict[str, Any]:
-        """Fetch full contact details (incl. phone) for each contact embedded in lead."""
-        contacts = (lead.get("_embedded") or {}).get("contacts") or []
-        enriched = []
-        for c in contacts:
-            cid = c.get("id")
-            if not cid:
-                enriched.append(c)
-                continue
-            try:
-                full_contact = self.amo.get(f"/api/v4/contacts/{cid}")
-                enriched.append(full_contact)
-            except Exception:
-                enriched.append(c)
-        if enriched:
-            lead.setdefault("_embedded", {})["contacts"] = enriched
-        return lead
+    # Contact chunks fetched concurrently by _batch_enrich_contacts.
+    _CONTACT_FETCH_WORKERS = 4
 
     def _batch_enrich_contacts(self, leads: List[Dict[str, Any]]) -> None:
         """Fetch contact details (phone etc.) for multiple leads in one batch request.
 
         AMO embeds contacts in lead responses but omits custom_fields_values (phone).
-        This collects all contact IDs missing that data, fetches them in chunks of 50,
+        This collects all contact IDs missing that data, fetches them in chunks of 250,
         then updates each lead's embedded contacts in-place.
         """
-        contact_ids: List[int] = []
-        for lead in leads:
-            for c in (lead.get("_embedded") or {}).get("contacts") or []:
-                cid = c.get("id")
-                if cid and not c.get("custom_fields_values") and cid not in contact_ids:
-                    contact_ids.append(cid)
+        # dict keeps first-seen order and gives O(1) de-duplication
+        contact_ids: List[int] = list({
+            c["id"]: None
+            for lead in leads
+            for c in (lead.get("_embedded") or {}).get("contacts") or []
+            if c.get("id") and not c.get("custom_fields_values")
+        })
         if not contact_ids:
             return
 
-        fetched: Dict[int, Dict[str, Any]] = {}
-        CHUNK = 50
-        for i in range(0, len(contact_ids), CHUNK):
-            chunk = contact_ids[i : i + CHUNK]
+        CHUNK = 250
+
+        def _fetch_chunk(chunk: List[int]) -> List[Dict[str, Any]]:
             ids_param = "&".join(f"filter[id][]={cid}" for cid in chunk)
             try:
                 data = self.amo.get(f"/api/v4/contacts?{ids_param}&limit={CHUNK}")
-                for contact in (data.get("_embedded") or {}).get("contacts") or []:
-                    fetched[int(contact["id"])] = contact
+                return (data.get("_embedded") or {}).get("contacts") or []
             except Exception as exc:
                 _log.error("_batch_enrich_contacts chunk failed: %s", exc)
+                return []
+
+        chunks = [contact_ids[i : i + CHUNK] for i in range(0, len(contact_ids), CHUNK)]
+        if len(chunks) == 1:
+            results = [_fetch_chunk(chunks[0])]
+        else:
+            # Large initial syncs span many chunks: overlap their round-trips (the
+            # AMO token bucket still paces the requests themselves).
+            with ThreadPoolExecutor(
+                max_workers=min(len(chunks), self._CONTACT_FETCH_WORKERS), thread_name_prefix="amo-contacts",
+            ) as pool:
+                results = list(pool.map(_fetch_chunk, chunks))
+        fetched: Dict[int, Dict[str, Any]] = {
+            int(contact["id"]): contact for batch in results for contact in batch
+        }
 
         if not fetched:
             return
 
         for lead in leads:
-            contacts = (lead.get("_embedded") or {}).get("contacts") or []
-            enriched = [
-                fetched.get(int(c["id"]), c) if c.get("id") else c
-                for c in contacts
-            ]
-            if enriched:
-                lead.setdefault("_embedded", {})["contacts"] = enriched
+            # Non-empty contacts imply _embedded is already a dict on the lead.
+            embedded = lead.get("_embedded")
+            contacts = embedded.get("contacts") if embedded else None
+            if contacts:
+                embedded["contacts"] = [
+                    fetched.get(int(c["id"]), c) if c.get("id") else c
+                    for c in contacts
+                ]
 
     def _record_kpi_event(
-        self, full_lead: Dict[str, Any], webhook_status_id: int
+        self, full_lead: Dict[str, Any], webhook_status_id: int, lead_id: str, pipeline_id: int
     ) -> None:
         """Record a KPI event (consul/zakas/dumka) based on the webhook transition.
 
         Uses webhook_status_id so we capture the transition that *happened*,
         even if the lead has since moved to a different status in AMO.
+        lead_id and pipeline_id are the values the webhook loop already resolved.
         """
         display_name = self.status_id_to_display_name.get(webhook_status_id, "")
         if not display_name:
             return
 
-        lead_id = str(full_lead.get("id", "")).strip()
-        if not lead_id:
+        # Pipeline keyword filter: only record KPI for sotuv-type pipelines
+        if not self._pipeline_in_scope(pipeline_id):
             return
-
-        pipeline_id   = int(full_lead.get("pipeline_id", 0) or 0)
         pipeline_name = self.pipeline_id_to_name.get(pipeline_id, "")
         budget        = float(full_lead.get("price", 0) or 0)
 
-        # Pipeline keyword filter: only record KPI for sotuv-type pipelines
-        if self.cfg.PIPELINE_KEYWORD:
-            if self.cfg.PIPELINE_KEYWORD not in pipeline_name.lower():
-                return
-
         try:
             if display_name in KPI_CONSUL_DISPLAY_NAMES:
                 staff_code = _extract_staff_code(full_lead)
@@ -1749,29 +2549,19 @@ class SyncService:
 
     def run_kpi_backfill(self, date_from: str, date_to: str) -> Dict[str, int]:
         """Replay AMO events for the given date range and populate the KPI store."""
-        pipeline_keyword = getattr(self.cfg, "PIPELINE_KEYWORD", "").lower()
-        sotuv_pipeline_ids: set[int] = set()
-        if pipeline_keyword:
-            for pid, pname in self.pipeline_id_to_name.items():
-                if pipeline_keyword in pname.lower():
-                    sotuv_pipeline_ids.add(pid)
-
-        all_pipeline_ids = set(self.pipeline_id_to_name.keys())
-        scope = sotuv_pipeline_ids or all_pipeline_ids
+        scope = set(self.keyword_pipeline_ids or self.pipeline_id_to_name.keys())
 
         consul_status_ids = set(self.trigger_status_ids)  # КОНСУЛЬТАЦИЯ IDs
 
         zakas_status_ids: set[int] = {
             sid
-            for pid in scope
-            for dname, sid in self.pipeline_status_display_to_id.get(pid, {}).items()
-            if dname in KPI_ZAKAS_DISPLAY_NAMES
+            for (pid, name), sid in self._status_lookup.items()
+            if pid in scope and name in KPI_ZAKAS_DISPLAY_NAMES
         }
         dumka_status_ids: set[int] = {
             sid
-            for pid in scope
-            for dname, sid in self.pipeline_status_display_to_id.get(pid, {}).items()
-            if dname in KPI_DUMKA_DISPLAY_NAMES
+            for (pid, name), sid in self._status_lookup.items()
+            if pid in scope and name in KPI_DUMKA_DISPLAY_NAMES
         }
 
         return self.kpi_store.backfill_from_amo(
@@ -1781,9 +2571,23 @@ class SyncService:
             consul_status_ids=consul_status_ids,
             zakas_status_ids=zakas_status_ids,
             dumka_status_ids=dumka_status_ids,
-            sotuv_pipeline_ids=sotuv_pipeline_ids,
+            sotuv_pipeline_ids=set(self.keyword_pipeline_ids),
         )
 
+    # A webhook payload modified less than this many seconds ago is trusted as-is.
+    _WEBHOOK_PAYLOAD_TRUST_SEC = 2
+
+    def _webhook_payload_is_fresh(self, lead: Dict[str, Any]) -> bool:
+        """True when the payload has pipeline/update info and is recent enough
+        that the lead cannot meaningfully have moved on in AMO since."""
+        if not lead.get("pipeline_id"):
+            return False
+        try:
+            updated_at = int(lead.get("updated_at") or lead.get("last_modified") or 0)
+        except (TypeError, ValueError):
+            return False
+        return updated_at >= time.time() - self._WEBHOOK_PAYLOAD_TRUST_SEC
+
     def process_webhook_leads(self, leads: List[Dict[str, Any]]) -> Dict[str, Any]:
         written = 0
         trigger_matches = 0
@@ -1792,25 +2596,35 @@ class SyncService:
         skipped_duplicate = 0
         skipped_status_mismatch = 0
         skipped_too_old = 0
-        seen_status_ids: List[int] = []
+        seen_status_ids: set[int] = set()
 
         staff_mapping = self.sheet.get_staff_mapping()
 
         # ── Pass 1: cheap local filtering — zero AMO API calls ────────────────────────────
         # Collect every lead that actually needs processing.  All checks here use
         # only local state so no network calls are made until the batch fetch below.
+        # Every qualifying event in arrival order: KPI recording must see each
+        # transition, even one a later event in the same (coalesced) batch superseded.
         qualifying: List[Dict[str, Any]] = []   # original webhook payloads
-        wh_status_map: Dict[str, int] = {}       # lead_id → webhook_status_id
+        # Fetch and sheet-write work only needs the latest qualifying event per lead;
+        # a repeated lead moves to the position of its last occurrence.
+        latest: Dict[str, Dict[str, Any]] = {}   # lead_id → last qualifying payload
         pre_known: Dict[str, str]      = {}       # lead_id → known sheet status (snapshot)
+        fetch_ids: set[int]            = set()    # leads whose payload is not enough
+        # Pass 1 only reads tracked statuses, so bind the state dict once per batch.
+        known_by_lead: Dict[str, str]  = self._status_by_lead
 
         for lead in leads:
             lead_id = str(lead.get("id", "")).strip()
             if not lead_id:
                 skipped_no_id += 1
                 continue
-
-            webhook_status_id = int(lead.get("status_id", 0) or 0)
-            seen_status_ids.append(webhook_status_id)
+            # Coerce numeric ids once; both passes (and the trusted-payload
+            # fallback in pass 2) then read plain ints.
+            for field in _WEBHOOK_INT_FIELDS:
+                lead[field] = _to_int(lead.get(field))
+            webhook_status_id = lead["status_id"]
+            seen_status_ids.add(webhook_status_id)
 
             # Deduplicate: amoCRM retries webhooks — skip if we already handled this exact event
             if self._is_duplicate_webhook(lead_id, webhook_status_id):
@@ -1825,8 +2639,8 @@ class SyncService:
                 continue
 
             is_trigger  = webhook_status_id in self.trigger_status_ids
-            is_terminal = str(webhook_status_id) in self.terminal_status_id_to_name
-            known_status = self.get_known_sheet_status(lead_id)
+            is_terminal = webhook_status_id in self.terminal_status_id_to_name
+            known_status = known_by_lead.get(lead_id, "")
 
             if not (is_trigger or is_terminal or known_status):
                 skipped_status_mismatch += 1
@@ -1837,84 +2651,94 @@ class SyncService:
                 continue
 
             qualifying.append(lead)
-            wh_status_map[lead_id] = webhook_status_id
-            pre_known[lead_id]     = known_status
-
-        # ── Batch fetch: ceil(N/50) lead GETs + ceil(C/50) contact GETs ───────────────
-        # For a bulk of N qualifying leads this replaces N individual lead GETs
-        # and N individual contact GETs with at most 2×ceil(N/50) requests.
-        qualifying_ids  = [int(lead["id"]) for lead in qualifying]
-        full_leads_map  = self.amo.batch_get_leads(qualifying_ids)
+            latest.pop(lead_id, None)
+            latest[lead_id]    = lead
+            pre_known[lead_id] = known_status
+            # A fresh terminal / status-change event carries everything its branch
+            # needs.  Only the trigger branch (build_row: contacts, custom fields),
+            # consul KPI (staff code) and possibly-stale payloads refetch from AMO.
+            if (
+                is_trigger
+                or self.status_id_to_display_name.get(webhook_status_id, "") in KPI_CONSUL_DISPLAY_NAMES
+                or not self._webhook_payload_is_fresh(lead)
+            ):
+                fetch_ids.add(int(lead_id))
+
+        # ── Batch fetch: ceil(N/250) lead GETs + ceil(C/250) contact GETs ─────────────
+        # For a bulk of N leads needing fresh data this replaces N individual lead
+        # GETs and N individual contact GETs with at most 2×ceil(N/250) requests.
+        full_leads_map  = self.amo.batch_get_leads(sorted(fetch_ids))
         self._batch_enrich_contacts(list(full_leads_map.values()))
 
-        # ── Pass 2: business logic — all data already in memory ──────────────────────
+        # ── KPI: every qualifying event, in arrival order ────────────────────────────
+        # KPI recording uses the webhook status_id so we capture what HAPPENED.
         for lead in qualifying:
-            lead_id           = str(lead["id"])
-            webhook_status_id = wh_status_map[lead_id]
+            lead_id   = str(lead["id"]).strip()
+            full_lead = full_leads_map.get(int(lead_id), lead)
+            self._record_kpi_event(full_lead, lead["status_id"], lead_id, _to_int(full_lead.get("pipeline_id")))
+
+        # ── Pass 2: business logic — all data already in memory ──────────────────────
+        # Sheet writes are queued here and applied by one flush_batch() afterwards.
+        sheet_writes: List[Dict[str, Any]] = []
+        # Loop invariants, resolved once per batch.
+        trigger_display  = _status_display_name(self.cfg.TRIGGER_STATUS_NAME) or self.cfg.TRIGGER_STATUS_NAME
+        for lead_id, lead in latest.items():
+            webhook_status_id = lead["status_id"]
             known_status      = pre_known[lead_id]
 
             full_lead = full_leads_map.get(int(lead_id))
             if full_lead is None:
-                # Batch fetch failed for this lead — fall back to webhook payload
+                # Not fetched (payload trusted) or batch fetch failed — use webhook payload
                 full_lead = lead
                 status_id = webhook_status_id
             else:
-                status_id = int(full_lead.get("status_id", 0) or 0)
-
-            # KPI recording uses webhook_status_id so we capture what HAPPENED
-            self._record_kpi_event(full_lead, webhook_status_id)
+                status_id = _to_int(full_lead.get("status_id"))
+            pipeline_id   = _to_int(full_lead.get("pipeline_id"))
+            pipeline_name = self.pipeline_id_to_name.get(pipeline_id, "")
 
             # Skip leads last updated before the configured cutoff (ignores stale history)
             if self.cfg.LEADS_CREATED_AFTER:
-                updated_at = int(full_lead.get("updated_at", 0) or 0)
+                updated_at = _to_int(full_lead.get("updated_at"))
                 if updated_at and updated_at < self.cfg.LEADS_CREATED_AFTER:
                     skipped_too_old += 1
                     _log_wh.debug("WEBHOOK lead=%s — updated_at too old (%d), skipped", lead_id, updated_at)
                     continue
 
             # Skip leads from pipelines not matching the keyword filter.
-            if self.cfg.PIPELINE_KEYWORD:
-                wh_pipeline_id   = int(full_lead.get("pipeline_id", 0) or 0)
-                wh_pipeline_name = self.pipeline_id_to_name.get(wh_pipeline_id, "")
-                if self.cfg.PIPELINE_KEYWORD not in wh_pipeline_name.lower():
-                    _log_wh.debug(
-                        "WEBHOOK lead=%s pipeline='%s' — keyword filter mismatch, skipped",
-                        lead_id, wh_pipeline_name,
-                    )
-                    continue
+            if not self._pipeline_in_scope(pipeline_id):
+                _log_wh.debug(
+                    "WEBHOOK lead=%s pipeline='%s' — keyword filter mismatch, skipped",
+                    lead_id, pipeline_name,
+                )
+                continue
 
             if status_id in self.trigger_status_ids:
                 trigger_matches  += 1
-                trigger_display   = STATUS_DISPLAY_MAP.get(self.cfg.TRIGGER_STATUS_NAME, self.cfg.TRIGGER_STATUS_NAME)
-                pipeline_id       = int(full_lead.get("pipeline_id", 0) or 0)
-                pipeline_name     = self.pipeline_id_to_name.get(pipeline_id, "")
-                responsible_id    = int(full_lead.get("responsible_user_id", 0) or 0)
+                responsible_id    = _to_int(full_lead.get("responsible_user_id"))
                 responsible_name  = self.users_map.get(responsible_id, str(responsible_id))
                 current_status_name = self.status_id_to_display_name.get(status_id, trigger_display)
 
                 tab_name = self._tab_for_lead(full_lead)
                 row = build_row(full_lead, current_status_name, pipeline_name, responsible_name, staff_mapping)
-                self.sheet.upsert_row(row, tab_name)
-                self.remember_sheet_status(lead_id, current_status_name)
-                self.remember_lead_tab(lead_id, tab_name)
-                self.remember_lead_pipeline(lead_id, pipeline_id)
-                _log_wh.info(
-                    "WEBHOOK TRIGGER lead=%s pipeline='%s' status='%s' → written to sheet tab='%s'",
-                    lead_id, pipeline_name, current_status_name, tab_name,
-                )
                 # Preserve any Заказ № already stored in AMO so that if a lead returns
                 # to the trigger status after the order number was filled, we do NOT
                 # reset known_order to "" and accidentally re-trigger the Заказ № push.
                 actual_order_num = str(row[ORDER_NUM_COL_INDEX]) if len(row) > ORDER_NUM_COL_INDEX else ""
-                self.remember_sheet_order_number(lead_id, actual_order_num)
+                sheet_writes.append({
+                    "op": "upsert", "tab": tab_name, "row": row, "lead_id": lead_id,
+                    "status": current_status_name, "pipeline_id": pipeline_id, "order_number": actual_order_num,
+                })
+                _log_wh.info(
+                    "WEBHOOK TRIGGER lead=%s pipeline='%s' status='%s' → written to sheet tab='%s'",
+                    lead_id, pipeline_name, current_status_name, tab_name,
+                )
                 written += 1
                 continue
 
-            terminal_name = self.terminal_status_id_to_name.get(str(status_id))
+            terminal_name = self.terminal_status_id_to_name.get(status_id)
             if terminal_name:
                 terminal_matches += 1
-                lead_pipeline_id  = int(full_lead.get("pipeline_id", 0) or 0)
-                sheet_display     = AMO_STATUS_TO_SHEET_OVERRIDE.get(terminal_name, terminal_name)
+                sheet_display     = self.status_id_to_sheet_status[status_id]
                 # When admin filled Заказ № → AMO moved to Заказ отправлен → webhook comes back as
                 # "У курера".  Sheet must stay "В процессе" until operator changes it manually.
                 if sheet_display == "У курера" and known_status == "В процессе":
@@ -1935,10 +2759,10 @@ class SyncService:
                         lead_id, terminal_name,
                     )
                     continue
-                self.sheet.update_status(lead_id, sheet_display, self.get_lead_tab(lead_id))
-                self.remember_sheet_status(lead_id, sheet_display)
-                self.remember_lead_pipeline(lead_id, lead_pipeline_id)
-                self._set_expiry_for_status(lead_id, sheet_display)
+                sheet_writes.append({
+                    "op": "status", "tab": self.get_lead_tab(lead_id), "lead_id": lead_id,
+                    "status": sheet_display, "pipeline_id": pipeline_id,
+                })
                 _log_wh.info(
                     "WEBHOOK TERMINAL lead=%s amo_status='%s' → sheet='%s'",
                     lead_id, terminal_name, sheet_display,
@@ -1946,8 +2770,7 @@ class SyncService:
                 written += 1
             else:
                 if known_status:
-                    new_status_display = self.status_id_to_display_name.get(status_id, str(status_id))
-                    sheet_display      = AMO_STATUS_TO_SHEET_OVERRIDE.get(new_status_display, new_status_display)
+                    sheet_display = self.status_id_to_sheet_status.get(status_id, str(status_id))
                     # Same suppression: Заказ отправлен webhook must not overwrite "В процессе"
                     if sheet_display == "У курера" and known_status == "В процессе":
                         skipped_status_mismatch += 1
@@ -1956,10 +2779,10 @@ class SyncService:
                     if sheet_display == "Успешно":
                         skipped_status_mismatch += 1
                         continue
-                    self.sheet.update_status(lead_id, sheet_display, self.get_lead_tab(lead_id))
-                    self.remember_sheet_status(lead_id, sheet_display)
-                    self.remember_lead_pipeline(lead_id, int(full_lead.get("pipeline_id", 0) or 0))
-                    self._set_expiry_for_status(lead_id, sheet_display)
+                    sheet_writes.append({
+                        "op": "status", "tab": self.get_lead_tab(lead_id), "lead_id": lead_id,
+                        "status": sheet_display, "pipeline_id": pipeline_id,
+                    })
                     _log_wh.info(
                         "WEBHOOK STATUS lead=%s amo_status_id=%d → sheet='%s'",
                         lead_id, status_id, sheet_display,
@@ -1969,8 +2792,13 @@ class SyncService:
                     skipped_status_mismatch += 1
                     _log_wh.debug("WEBHOOK lead=%s status_id=%d — not known/tracked, skipped", lead_id, status_id)
 
-        # Flush all state mutations accumulated during this batch in one disk write
-        self.flush_state()
+        # State follows the sheet: it is only updated once the writes went through.
+        self.sheet.flush_batch(sheet_writes)
+        self._remember_sheet_writes(sheet_writes)
+
+        # State mutations from this batch are written by the background flusher,
+        # off the webhook response path.
+        self.request_state_flush()
         _log_wh.info(
             "WEBHOOK BATCH done: received=%d written=%d triggers=%d terminals=%d "
             "skip_dup=%d skip_old=%d skip_mismatch=%d",
@@ -1986,7 +2814,7 @@ class SyncService:
             "skipped_duplicate": skipped_duplicate,
             "skipped_status_mismatch": skipped_status_mismatch,
             "skipped_too_old": skipped_too_old,
-            "seen_status_ids": sorted(list(set(seen_status_ids))),
+            "seen_status_ids": sorted(seen_status_ids),
             "resolved_trigger_status_ids": sorted(self.trigger_status_ids),
             "configured_terminal_status_ids": self.cfg.STATUS_MAP,
         }
@@ -2000,7 +2828,7 @@ class SyncService:
         this message appears exactly once (not on every subsequent poll cycle).
         """
         with self.state_lock:
-            tracked = dict(self.state.get("lead_tab_by_lead", {}))
+            tracked = dict(self._tab_by_lead)
         for lead_id, tab in tracked.items():
             if lead_id in visible_ids:
                 continue
@@ -2016,188 +2844,249 @@ class SyncService:
             )
             # Forget immediately so this warning fires exactly once, not every poll.
             self.forget_lead(lead_id)
-        self.flush_state()
+        self.request_state_flush()
 
-    def sync_sheet_to_amo(self) -> None:
-        # Only scan the current-month tab plus any archived tab that still hosts
-        # a live (non-terminal) lead.  This avoids reading old monthly tabs that
-        # contain only finalised leads and will never produce a status change.
-        _terminal_statuses = {"Успешно", "Отказ", "Закрыто и не реализовано"}
+    # Sheet statuses after which a lead never produces another sheet→AMO change.
+    _FINISHED_SHEET_STATUSES: frozenset = frozenset({"Успешно", "Отказ", "Закрыто и не реализовано"})
+
+    def _active_tabs(self) -> set:
+        """Tabs the poller must scan: the current month, the main tab, and any
+        archived tab that still hosts a live (non-finished) lead."""
         _tz = timezone(timedelta(hours=self.cfg.DISPLAY_TZ_OFFSET))
-        _active_tabs: set = {
+        active: set = {
             datetime.now(_tz).strftime("%m.%Y"),  # current month — always scan
             self.cfg.GOOGLE_WORKSHEET_NAME,        # legacy / main tab
         }
-        for _lid, _tab in self.state.get("lead_tab_by_lead", {}).items():
-            if self.state.get("sheet_status_by_lead", {}).get(_lid, "") not in _terminal_statuses:
-                _active_tabs.add(_tab)
-        rows = self.sheet.iter_lead_statuses(tabs_filter=_active_tabs)
+        statuses = self._status_by_lead
+        for _lid, _tab in list(self._tab_by_lead.items()):
+            if statuses.get(_lid, "") not in self._FINISHED_SHEET_STATUSES:
+                active.add(_tab)
+        return active
+
+    def sync_sheet_to_amo(self) -> None:
+        # Only scan the current-month tab plus any archived tab that still hosts
+        # a live (non-terminal) lead.  This avoids reading old monthly tabs that
+        # contain only finalised leads and will never produce a status change.
+        rows = self.sheet.iter_lead_statuses(tabs_filter=self._active_tabs())
         visible_ids = {item["lead_id"] for item in rows}
         self._detect_deleted_rows(visible_ids)
-        for item in rows:
-            lead_id = item["lead_id"]
-            status_name = item["status"]
-            order_number = item.get("order_number", "")
-
-            # ── Order-number trigger: Заказ № filled by admin → move to Заказ отправлен ──
+        # Most rows match the tracked state; only the changed ones cost AMO calls.
+        # Those are pushed by a small pool so their round-trips overlap (the
+        # shared token bucket still caps the request rate).
+        changed = [item for item in rows if self._sheet_row_changed(item)]
+        if not changed:
+            # Idle poll: nothing to push, no AMO call and no state flush needed.
+            return
+        self._prefetch_lead_pipelines(changed)
+        if len(changed) > 1 and self.cfg.SHEET_SYNC_WORKERS > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(self.cfg.SHEET_SYNC_WORKERS, len(changed)),
+                thread_name_prefix="sheet-sync",
+            ) as pool:
+                list(pool.map(self._sync_sheet_row, changed))
+        else:
+            for item in changed:
+                self._sync_sheet_row(item)
+        # One disk write for all status updates in this poll cycle
+        self.request_state_flush()
+
+    def _sheet_row_changed(self, item: Dict[str, str]) -> bool:
+        """Cheap local pre-check: could _sync_sheet_row do anything for this row?"""
+        lead_id = item["lead_id"]
+        status_name = item["status"]
+        order_number = item.get("order_number", "")
+        if lead_id in self._order_by_lead:
             known_order = self.get_known_order_number(lead_id)
-            # Only act if ALL of:
-            #  • we have previously tracked this lead (key present in state),
-            #  • the order number was empty before (known_order is ""),
-            #  • it is now non-empty in the sheet,
-            #  • the lead is still in "В процессе" — the stage where admin writes the
-            #    order number.  If the lead is already at Отказ, Успешно, or У курера
-            #    (came from a backward/forward AMO move), do NOT re-trigger this push.
-            #    This prevents an infinite loop when a lead with a filled Заказ №
-            #    is manually moved back to the trigger status by a manager.
-            order_was_tracked = str(lead_id) in self.state.get("sheet_order_number_by_lead", {})
-            if order_was_tracked and not known_order and order_number and status_name == "В процессе":
-                try:
-                    lead_pipeline_id = self.get_lead_pipeline(lead_id)
-                    if not lead_pipeline_id:
-                        _p = self.amo.get(f"/api/v4/leads/{lead_id}")
-                        lead_pipeline_id = int(_p.get("pipeline_id", 0) or 0)
-                        if lead_pipeline_id:
-                            self.remember_lead_pipeline(lead_id, lead_pipeline_id)
-                    status_id = self.pipeline_status_display_to_id.get(lead_pipeline_id, {}).get(ORDER_NUM_FILLED_AMO_STATUS_DISPLAY)
-                    if not status_id:
-                        status_id = self.pipeline_status_name_to_id.get(lead_pipeline_id, {}).get("Заказ отправлен")
-                    if status_id:
-                        self.amo.patch(
-                            f"/api/v4/leads/{lead_id}",
-                            {
-                                "status_id": status_id,
-                                "pipeline_id": lead_pipeline_id or self.cfg.PIPELINE_ID,
-                                "custom_fields_values": [
-                                    {
-                                        "field_id": 987889,
-                                        "values": [{"value": order_number}],
-                                    }
-                                ],
-                            },
-                        )
-                        _log_lead.info(
-                            "LEAD %s order# filled ('%s') → AMO PATCH sent (status_id=%d pipeline=%d)",
-                            lead_id, order_number, status_id, lead_pipeline_id,
-                        )
-                        # Remember ONLY after a successful PATCH — if status_id was
-                        # not found we must NOT update state so the trigger retries
-                        # on the next poll cycle (after a service restart or fix).
-                        self.remember_sheet_order_number(lead_id, order_number)
-                    else:
-                        _log_lead.warning(
-                            "LEAD %s order# filled ('%s') but no 'Заказ отправлен' status ID found for pipeline %d",
-                            lead_id, order_number, lead_pipeline_id,
-                        )
-                except Exception as exc:
-                    if "Lead not found" in str(exc):
-                        _log.warning(
-                            "Lead %s no longer exists in AMO (deleted/merged) — "
-                            "suppressing order# push and marking as handled",
-                            lead_id,
-                        )
-                        self.remember_sheet_order_number(lead_id, order_number)
-                    else:
-                        _log.error("Failed to push order# for lead %s: %s", lead_id, exc)
+            if known_order != order_number and (known_order or status_name == "В процессе"):
+                return True
+        return (
+            status_name in self.cfg.STATUS_MAP
+            and status_name != "Успешно"
+            and self.get_known_sheet_status(lead_id) != status_name
+        )
 
-            # ── Order-number update/clear: Заказ № changed or erased → sync to AMO field ──
-            # This fires when the order number was already tracked (non-empty known_order)
-            # and the sheet value differs — covers both edits and clearing the cell.
-            elif order_was_tracked and known_order and known_order != order_number:
-                try:
-                    # AMO custom field 987889 accepts an empty string to clear the value.
-                    patch_value = order_number  # may be "" to clear
+    def _prefetch_lead_pipelines(self, items: List[Dict[str, str]]) -> None:
+        """Look up, in one batched AMO request, the pipelines of changed rows that
+        _resolve_lead_pipeline could not resolve locally.
+
+        Leads missing from the batch result are left to the per-lead GET, which
+        also reports deleted leads.
+        """
+        unresolved = [
+            int(item["lead_id"]) for item in items
+            if item["lead_id"].isdigit()
+            and not self.get_lead_pipeline(item["lead_id"])
+            and not self.pipeline_display_to_id.get(item.get("pipeline_display", ""))
+        ]
+        if len(unresolved) < 2:
+            return
+        for lid, lead in self.amo.batch_get_leads(unresolved).items():
+            self.remember_lead_pipeline(str(lid), _to_int(lead.get("pipeline_id")))
+
+    def _resolve_lead_pipeline(self, item: Dict[str, str]) -> int:
+        """pipeline_id for a sheet row: tracked state, then the row's Воронка cell,
+        and only as a last resort a GET to AMO."""
+        lead_id = item["lead_id"]
+        pipeline_id = self.get_lead_pipeline(lead_id)
+        if pipeline_id:
+            return pipeline_id
+        pipeline_id = self.pipeline_display_to_id.get(item.get("pipeline_display", ""), 0)
+        if not pipeline_id:
+            _p = self.amo.get(f"/api/v4/leads/{lead_id}")
+            pipeline_id = _to_int(_p.get("pipeline_id"))
+        self.remember_lead_pipeline(lead_id, pipeline_id)
+        return pipeline_id
+
+    def _sync_sheet_row(self, item: Dict[str, str]) -> None:
+        """Push one sheet row's order-number / status change to AMO."""
+        lead_id = item["lead_id"]
+        status_name = item["status"]
+        order_number = item.get("order_number", "")
+
+        # ── Order-number trigger: Заказ № filled by admin → move to Заказ отправлен ──
+        known_order = self.get_known_order_number(lead_id)
+        # Only act if ALL of:
+        #  • we have previously tracked this lead (key present in state),
+        #  • the order number was empty before (known_order is ""),
+        #  • it is now non-empty in the sheet,
+        #  • the lead is still in "В процессе" — the stage where admin writes the
+        #    order number.  If the lead is already at Отказ, Успешно, or У курера
+        #    (came from a backward/forward AMO move), do NOT re-trigger this push.
+        #    This prevents an infinite loop when a lead with a filled Заказ №
+        #    is manually moved back to the trigger status by a manager.
+        order_was_tracked = lead_id in self._order_by_lead
+        if order_was_tracked and not known_order and order_number and status_name == "В процессе":
+            try:
+                lead_pipeline_id = self._resolve_lead_pipeline(item)
+                status_id = (
+                    self.resolve_status_id(lead_pipeline_id, ORDER_NUM_FILLED_AMO_STATUS_DISPLAY)
+                    or self.resolve_status_id(lead_pipeline_id, "Заказ отправлен")
+                )
+                if status_id:
                     self.amo.patch(
                         f"/api/v4/leads/{lead_id}",
                         {
+                            "status_id": status_id,
+                            "pipeline_id": lead_pipeline_id or self.cfg.PIPELINE_ID,
                             "custom_fields_values": [
                                 {
                                     "field_id": 987889,
-                                    "values": [{"value": patch_value}],
+                                    "values": [{"value": order_number}],
                                 }
                             ],
                         },
                     )
                     _log_lead.info(
-                        "LEAD %s order# changed ('%s' → '%s') → AMO field updated",
-                        lead_id, known_order, order_number,
+                        "LEAD %s order# filled ('%s') → AMO PATCH sent (status_id=%d pipeline=%d)",
+                        lead_id, order_number, status_id, lead_pipeline_id,
                     )
+                    # Remember ONLY after a successful PATCH — if status_id was
+                    # not found we must NOT update state so the trigger retries
+                    # on the next poll cycle (after a service restart or fix).
                     self.remember_sheet_order_number(lead_id, order_number)
-                except Exception as exc:
-                    if "Lead not found" in str(exc):
-                        _log.warning(
-                            "Lead %s no longer exists in AMO (deleted/merged) — "
-                            "suppressing order# update and marking as handled",
-                            lead_id,
-                        )
-                        self.remember_sheet_order_number(lead_id, order_number)
-                    else:
-                        _log.error("Failed to update order# for lead %s: %s", lead_id, exc)
-
-            # ── Status trigger: sheet status changed → push to AMO ──
-            if status_name not in self.cfg.STATUS_MAP:
-                continue
-
-            # "Успешно" is a display-only label for staff — never push it to AMO.
-            # (AMO itself writes "Успешно реализовано" which the webhook maps back to
-            # the "Успешно" display label; we must not reverse-patch that back.)
-            if status_name == "Успешно":
-                continue
-
-            known = self.get_known_sheet_status(lead_id)
-            if known == status_name:
-                continue
-
-            try:
-                lead_pipeline_id = self.get_lead_pipeline(lead_id)
-                if not lead_pipeline_id:
-                    _p = self.amo.get(f"/api/v4/leads/{lead_id}")
-                    lead_pipeline_id = int(_p.get("pipeline_id", 0) or 0)
-                    if lead_pipeline_id:
-                        self.remember_lead_pipeline(lead_id, lead_pipeline_id)
-
-                # Translate the sheet status to the AMO display name we want to target
-                amo_lookup = SHEET_STATUS_TO_AMO_DISPLAY.get(status_name, status_name)
-
-                # When an operator moves a lead back to "В процессе" and the lead
-                # already has a Заказ №, it means the order was issued — push to
-                # ЗАКАЗ ОТПРАВЛЕН instead of ЗАКАЗ БЕЗ НУМЕРАЦИИ.
-                if status_name == "В процессе" and order_number:
-                    amo_lookup = ORDER_NUM_FILLED_AMO_STATUS_DISPLAY  # "У курера" → ЗАКАЗ ОТПРАВЛЕН
-
-                status_id = self.pipeline_status_display_to_id.get(lead_pipeline_id, {}).get(amo_lookup)
-                if not status_id:
-                    status_id = self.pipeline_status_name_to_id.get(lead_pipeline_id, {}).get(amo_lookup)
-                if not status_id:
-                    status_id = self.cfg.STATUS_MAP.get(amo_lookup)
-
-                if not status_id:
+                else:
+                    _log_lead.warning(
+                        "LEAD %s order# filled ('%s') but no 'Заказ отправлен' status ID found for pipeline %d",
+                        lead_id, order_number, lead_pipeline_id,
+                    )
+            except Exception as exc:
+                if "Lead not found" in str(exc):
                     _log.warning(
-                        "No status ID mapping for lead %s, sheet status '%s', pipeline %d",
-                        lead_id, status_name, lead_pipeline_id,
+                        "Lead %s no longer exists in AMO (deleted/merged) — "
+                        "suppressing order# push and marking as handled",
+                        lead_id,
                     )
-                    continue
+                    self.remember_sheet_order_number(lead_id, order_number)
+                else:
+                    _log.error("Failed to push order# for lead %s: %s", lead_id, exc)
 
+        # ── Order-number update/clear: Заказ № changed or erased → sync to AMO field ──
+        # This fires when the order number was already tracked (non-empty known_order)
+        # and the sheet value differs — covers both edits and clearing the cell.
+        elif order_was_tracked and known_order and known_order != order_number:
+            try:
+                # AMO custom field 987889 accepts an empty string to clear the value.
+                patch_value = order_number  # may be "" to clear
                 self.amo.patch(
                     f"/api/v4/leads/{lead_id}",
                     {
-                        "status_id": status_id,
-                        "pipeline_id": lead_pipeline_id or self.cfg.PIPELINE_ID,
+                        "custom_fields_values": [
+                            {
+                                "field_id": 987889,
+                                "values": [{"value": patch_value}],
+                            }
+                        ],
                     },
                 )
-                self.remember_sheet_status(lead_id, status_name)
+                _log_lead.info(
+                    "LEAD %s order# changed ('%s' → '%s') → AMO field updated",
+                    lead_id, known_order, order_number,
+                )
+                self.remember_sheet_order_number(lead_id, order_number)
             except Exception as exc:
                 if "Lead not found" in str(exc):
                     _log.warning(
                         "Lead %s no longer exists in AMO (deleted/merged) — "
-                        "suppressing status sync and marking as handled to stop retries",
+                        "suppressing order# update and marking as handled",
                         lead_id,
                     )
-                    self.remember_sheet_status(lead_id, status_name)
+                    self.remember_sheet_order_number(lead_id, order_number)
                 else:
-                    _log.error("Failed to sync sheet→amo for lead %s: %s", lead_id, exc)
-        # One disk write for all status updates in this poll cycle
-        self.flush_state()
+                    _log.error("Failed to update order# for lead %s: %s", lead_id, exc)
+
+        # ── Status trigger: sheet status changed → push to AMO ──
+        if status_name not in self.cfg.STATUS_MAP:
+            return
+
+        # "Успешно" is a display-only label for staff — never push it to AMO.
+        # (AMO itself writes "Успешно реализовано" which the webhook maps back to
+        # the "Успешно" display label; we must not reverse-patch that back.)
+        if status_name == "Успешно":
+            return
+
+        known = self.get_known_sheet_status(lead_id)
+        if known == status_name:
+            return
+
+        try:
+            lead_pipeline_id = self._resolve_lead_pipeline(item)
+
+            # Translate the sheet status to the AMO display name we want to target
+            amo_lookup = SHEET_STATUS_TO_AMO_DISPLAY.get(status_name, status_name)
+
+            # When an operator moves a lead back to "В процессе" and the lead
+            # already has a Заказ №, it means the order was issued — push to
+            # ЗАКАЗ ОТПРАВЛЕН instead of ЗАКАЗ БЕЗ НУМЕРАЦИИ.
+            if status_name == "В процессе" and order_number:
+                amo_lookup = ORDER_NUM_FILLED_AMO_STATUS_DISPLAY  # "У курера" → ЗАКАЗ ОТПРАВЛЕН
+
+            status_id = self.resolve_status_id(lead_pipeline_id, amo_lookup)
+
+            if not status_id:
+                _log.warning(
+                    "No status ID mapping for lead %s, sheet status '%s', pipeline %d",
+                    lead_id, status_name, lead_pipeline_id,
+                )
+                return
+
+            self.amo.patch(
+                f"/api/v4/leads/{lead_id}",
+                {
+                    "status_id": status_id,
+                    "pipeline_id": lead_pipeline_id or self.cfg.PIPELINE_ID,
+                },
+            )
+            self.remember_sheet_status(lead_id, status_name)
+        except Exception as exc:
+            if "Lead not found" in str(exc):
+                _log.warning(
+                    "Lead %s no longer exists in AMO (deleted/merged) — "
+                    "suppressing status sync and marking as handled to stop retries",
+                    lead_id,
+                )
+                self.remember_sheet_status(lead_id, status_name)
+            else:
+                _log.error("Failed to sync sheet→amo for lead %s: %s", lead_id, exc)
 
 
 # ────────────────────────────────────────────────────────────────────────────────
@@ -2250,19 +3139,35 @@ app = FastAPI(title="amoCRM <-> Google Sheets Sync")
 # AMO disables webhooks when the endpoint doesn't respond within ~5 seconds.
 # We return 200 immediately and process leads asynchronously in this queue.
 _webhook_queue: queue.Queue = queue.Queue()
+# A burst of webhooks (AMO sends one request per lead move) is coalesced into one
+# process_webhook_leads call: after the first payload arrives the worker keeps
+# collecting for up to this many seconds / payloads, so the whole burst shares
+# one batch lead fetch and one state flush.
+_WEBHOOK_COALESCE_SEC = 0.05
+_WEBHOOK_COALESCE_MAX = 25
 
 
 def _webhook_worker() -> None:
-    """Background thread: drains _webhook_queue and processes each batch."""
+    """Background thread: drains _webhook_queue, coalescing bursts into one batch."""
     while True:
         try:
-            leads = _webhook_queue.get()
+            batches = [_webhook_queue.get()]
+            deadline = time.monotonic() + _WEBHOOK_COALESCE_SEC
+            while len(batches) < _WEBHOOK_COALESCE_MAX:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batches.append(_webhook_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
             try:
-                service.process_webhook_leads(leads)
+                service.process_webhook_leads([lead for batch in batches for lead in batch])
             except Exception as exc:
                 _log.error("Webhook worker error: %s", exc)
             finally:
-                _webhook_queue.task_done()
+                for _ in batches:
+                    _webhook_queue.task_done()
         except Exception as exc:
             _log.error("Webhook worker fatal error: %s", exc)
 
@@ -2274,16 +3179,53 @@ threading.Thread(target=_webhook_worker, daemon=True, name="webhook-worker").sta
 app.include_router(create_dashboard_router(DashboardContext(service)))
 
 
+# Strong references to fire-and-forget asyncio tasks (the loop only keeps weak ones).
+_background_tasks: set = set()
+
+
+def _sync_cycle() -> None:
+    service.check_and_rotate_sheet()
+    service.expire_finished_leads()
+    service.sync_sheet_to_amo()
+
+
+async def _sync_loop() -> None:
+    """Sheet → AMO poll loop, scheduled on the event loop.
+
+    Idle waits are asyncio.sleep, so no thread is pinned between polls; each
+    cycle's blocking AMO/Sheets I/O runs in the threadpool.
+    """
+    quota_hits = 0
+    while True:
+        try:
+            await run_in_threadpool(_sync_cycle)
+            quota_hits = 0
+        except Exception as exc:
+            _log.error("Sheet sync worker error: %s", exc)
+            # Per-call retries already ran; a quota error here means sustained
+            # pressure, so back off the whole cycle on top of the poll interval.
+            if _is_rate_limited(exc):
+                quota_hits += 1
+                backoff = _backoff_delay(quota_hits, _retry_after(exc), base=30.0, cap=300.0)
+                _log.warning("Sheets quota hit — backing off %.0fs", backoff)
+                await asyncio.sleep(backoff)
+                continue
+        await asyncio.sleep(service.cfg.SYNC_POLL_SECONDS)
+
+
 @app.on_event("startup")
-def on_startup() -> None:
+async def on_startup() -> None:
+    # Startup work is blocking AMO/Sheets I/O, so it runs in the threadpool and
+    # the event loop stays responsive (signals, backoff sleeps) meanwhile.
     # Check for month rollover before bootstrapping state
-    service.check_and_rotate_sheet()
+    await run_in_threadpool(service.check_and_rotate_sheet)
 
     # Run initial date-range sync before bootstrapping sheet state so that
     # leads pulled from AMO are immediately reflected in the local state.
     if service.cfg.INITIAL_SYNC_DATE_FROM and service.cfg.INITIAL_SYNC_DATE_TO:
         try:
-            service.initial_sync_leads(
+            await run_in_threadpool(
+                service.initial_sync_leads,
                 service.cfg.INITIAL_SYNC_DATE_FROM,
                 service.cfg.INITIAL_SYNC_DATE_TO,
             )
@@ -2296,40 +3238,23 @@ def on_startup() -> None:
     # triggering a systemd restart that would cause AMO to blacklist the webhook.
     for attempt in range(1, 6):
         try:
-            service.bootstrap_sheet_state()
+            await run_in_threadpool(service.bootstrap_sheet_state)
             break
         except Exception as exc:
-            msg = str(exc)
-            if "429" in msg or "Quota exceeded" in msg:
-                wait = attempt * 30
-                _log.warning("Sheets quota hit during bootstrap (attempt %d), retrying in %ds...", attempt, wait)
-                time.sleep(wait)
+            if _is_rate_limited(exc):
+                wait = _backoff_delay(attempt, _retry_after(exc), base=15.0, cap=150.0)
+                _log.warning("Sheets quota hit during bootstrap (attempt %d), retrying in %.0fs...", attempt, wait)
+                await asyncio.sleep(wait)
             elif attempt < 5:
-                _log.error("Bootstrap attempt %d failed (%s) — retrying in 30s...", attempt, exc)
-                time.sleep(30)
+                wait = _backoff_delay(attempt - 1, base=30.0, cap=120.0)
+                _log.error("Bootstrap attempt %d failed (%s) — retrying in %.0fs...", attempt, exc, wait)
+                await asyncio.sleep(wait)
             else:
                 _log.error("Bootstrap failed after 5 attempts (%s) — starting with empty state", exc)
 
-    def worker() -> None:
-        backoff = 0
-        while True:
-            try:
-                service.check_and_rotate_sheet()
-                service.expire_finished_leads()
-                service.sync_sheet_to_amo()
-                backoff = 0
-            except Exception as exc:
-                msg = str(exc)
-                _log.error("Sheet sync worker error: %s", msg)
-                if "429" in msg or "Quota exceeded" in msg:
-                    backoff = min(backoff + 60, 300)
-                    _log.warning("Sheets quota hit — backing off %ds", backoff)
-                    time.sleep(backoff)
-                    continue
-            time.sleep(service.cfg.SYNC_POLL_SECONDS)
-
-    t = threading.Thread(target=worker, daemon=True)
-    t.start()
+    task = asyncio.create_task(_sync_loop())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
     # ── KPI backfill (runs in background so startup is not blocked) ─────────
     kpi_backfill_date = os.getenv("KPI_BACKFILL_DATE", "").strip()
@@ -2357,7 +3282,8 @@ async def kpi_backfill_endpoint(request: Request) -> Dict[str, Any]:
     """Manually trigger a KPI back-fill for a date range.
 
     Body JSON: {"date_from": "YYYY-MM-DD", "date_to": "YYYY-MM-DD"}
-    Runs synchronously; may take a while for large date ranges.
+    Runs in the threadpool (the event loop stays free); may take a while for
+    large date ranges.
     """
     try:
         payload = await request.json()
@@ -2368,9 +3294,13 @@ async def kpi_backfill_endpoint(request: Request) -> Dict[str, Any]:
     date_to   = (payload.get("date_to")   or _date.today().strftime("%Y-%m-%d")).strip()
     if not date_from:
         return {"status": "error", "message": "date_from is required (YYYY-MM-DD)"}
-    try:
+    def _backfill() -> Dict[str, int]:
         counts = service.run_kpi_backfill(date_from, date_to)
         service.kpi_store.mark_backfill_done(date_from, date_to)
+        return counts
+
+    try:
+        counts = await run_in_threadpool(_backfill)
         return {"status": "ok", "date_from": date_from, "date_to": date_to, **counts}
     except Exception as exc:
         return {"status": "error", "message": str(exc)}
@@ -2392,10 +3322,14 @@ async def kpi_reset_endpoint(request: Request) -> Dict[str, Any]:
     date_to   = (payload.get("date_to")   or _date.today().strftime("%Y-%m-%d")).strip()
     if not date_from:
         return {"status": "error", "message": "date_from is required (YYYY-MM-DD)"}
-    try:
+    def _reset_and_backfill() -> Dict[str, int]:
         service.kpi_store.clear_all_data()
         counts = service.run_kpi_backfill(date_from, date_to)
         service.kpi_store.mark_backfill_done(date_from, date_to)
+        return counts
+
+    try:
+        counts = await run_in_threadpool(_reset_and_backfill)
         return {"status": "ok", "date_from": date_from, "date_to": date_to, **counts}
     except Exception as exc:
         return {"status": "error", "message": str(exc)}
@@ -2452,7 +3386,7 @@ async def oauth_exchange(payload: Dict[str, str]) -> Dict[str, Any]:
     redirect = payload.get("redirect_url") or payload.get("code") or ""
     if not redirect:
         return {"status": "error", "message": "Pass redirect_url or code"}
-    data = service.amo.exchange_code(redirect)
+    data = await run_in_threadpool(service.amo.exchange_code, redirect)
     return {"status": "ok", "token_saved": bool(data.get("access_token"))}
 
 
@@ -2460,11 +3394,12 @@ async def oauth_exchange(payload: Dict[str, str]) -> Dict[str, Any]:
 async def webhook_amocrm(request: Request) -> Dict[str, Any]:
     raw = await request.body()
     content_type = request.headers.get("content-type", "")
-    payload = parse_payload(raw, content_type)
-    leads = extract_leads(payload)
-    # Enqueue for async processing — return 200 immediately so AMO never
-    # marks this webhook as failed due to a slow response.
-    _webhook_queue.put(leads)
+    leads = parse_webhook_leads(raw, content_type)
+    # Enqueue for the webhook-worker thread — return 200 immediately so AMO never
+    # marks this webhook as failed due to a slow response, and no AMO/Sheets I/O
+    # ever runs on the event loop.
+    if leads:
+        _webhook_queue.put(leads)
     return {"status": "ok"}
 
 